@@ -3,6 +3,81 @@ import argparse
 import numpy as np
 import matplotlib.pyplot as plt
 
+# bump when a change in the generation would change the angles, to invalidate cached sequences
+ALGORITHM_VERSION = 1
+
+
+def radical_inverse(index, prime):
+    """Compute the radical inverse of an array of indices
+
+    Parameters
+    ----------
+    index : array_like
+        Non negative integer indices
+    prime : int or array_like
+        Base of the radical inverse (prime sequence index). An array of bases
+        is broadcast against index
+
+    Returns
+    -------
+    r : ndarray
+        numpy array with the radical inverse of each index, in [0, 1)
+    """
+
+    prime = np.asarray(prime)
+    if np.any(prime < 2):
+        raise ValueError('prime must be >= 2, got %s' % prime)
+
+    b = np.asarray(index, dtype=np.float64)
+    r = np.zeros(np.broadcast(b, prime).shape)
+    q = 1 / prime.astype(np.float64)
+    # same digit by digit accumulation as the scalar version so the results are bit-identical
+    while np.any(b != 0):
+        a = np.mod(b, prime)
+        r += (a * q)
+        q = q / prime
+        b = np.floor(b / prime)
+
+    return r
+
+
+def interlaced_angle_slice(start, stop, nproj_per_rot, prime, continuous_angle=True):
+    """Generate the elements [start, stop) of an interlaced angle sequence
+
+    Parameters
+    ----------
+    start : int
+        Index of the first projection
+    stop : int
+        Index past the last projection
+    nproj_per_rot : int
+        Nunber of projections in each rotation
+    prime : int
+        prime sequence index
+    continuous_angle : bool
+        Add 360 deg for each completed rotation
+
+    Returns
+    -------
+    theta : ndarray
+        1D numpy array containing the interlaced rotation angles
+    """
+
+    idx = np.arange(start, stop)
+    rot = idx // nproj_per_rot
+    k = idx - rot * nproj_per_rot
+
+    first_rot = start // nproj_per_rot
+    last_rot = (stop - 1) // nproj_per_rot
+    r = radical_inverse(np.arange(first_rot, last_rot + 1), prime)
+    r *= (360.0 / nproj_per_rot)
+
+    theta = r[rot - first_rot] + k * 360.0 / nproj_per_rot
+    if continuous_angle:
+        theta += rot * 360.0
+
+    return theta
+
 
 def interlaced_angle_sequence(nproj_total, nproj_per_rot, prime, continuous_angle=True):
     """Generate a sequence of interlaced angled
@@ -11,10 +86,12 @@ def interlaced_angle_sequence(nproj_total, nproj_per_rot, prime, continuous_angl
     ----------
     nproj_total : int
         Number of total projections
-     nproj_per_rot : int
+    nproj_per_rot : int
         Nunber of projections in each rotation
     prime : int
         prime sequence index
+    continuous_angle : bool
+        Add 360 deg for each completed rotation
 
     Returns
 
@@ -22,40 +99,139 @@ def interlaced_angle_sequence(nproj_total, nproj_per_rot, prime, continuous_angl
         1D numpy array containing the interlaced rotation angles
     """
 
+    return interlaced_angle_slice(0, nproj_total, nproj_per_rot, prime, continuous_angle)
 
+def interlaced_angle_chunks(nproj_total, nproj_per_rot, prime, continuous_angle=True, chunk_size=None):
+    """Generate a sequence of interlaced angles in chunks
 
-    seq = []
-    i = 0
+    Only one chunk is in memory at a time, so the sequence can be planned for
+    any number of projections, including an unbounded continuous rotation.
+    Concatenating the chunks gives the same result as interlaced_angle_sequence()
 
-    while len(seq) < nproj_total:
+    Parameters
+    ----------
+    nproj_total : int or None
+        Number of total projections. None to generate angles forever
+    nproj_per_rot : int
+        Nunber of projections in each rotation
+    prime : int
+        prime sequence index
+    continuous_angle : bool
+        Add 360 deg for each completed rotation
+    chunk_size : int or None
+        Number of projections in each chunk. None to yield one rotation at a time
 
-        b = i
-        i += 1
-        r = 0
-        q = 1 / prime
+    Yields
+    ------
+    theta : ndarray
+        1D numpy array containing the next chunk of interlaced rotation angles
+    """
 
-        while (b != 0):
-            a = np.mod(b, prime)
-            r += (a * q)
-            q /= prime
-            b = np.floor(b / prime)
-        r *= (360.0 / nproj_per_rot)
+    if chunk_size is None:
+        chunk_size = nproj_per_rot
+    if chunk_size < 1:
+        raise ValueError('chunk_size must be >= 1, got %s' % chunk_size)
 
-        k = 0
-        while (np.logical_and(len(seq) < nproj_total, k < nproj_per_rot)):
-            seq.append(r + k * 360.0 / nproj_per_rot )
-            k += 1
+    start = 0
+    while nproj_total is None or start < nproj_total:
+        stop = start + chunk_size
+        if nproj_total is not None:
+            stop = min(stop, nproj_total)
+        yield interlaced_angle_slice(start, stop, nproj_per_rot, prime, continuous_angle)
+        start = stop
+
+def interlace_sweep(primes, nproj_per_rots, nrot=16):
+    """Evaluate and rank the angular coverage of interlacing parameters
+
+    All (prime, nproj_per_rot) pairs are evaluated in one batch. Within a rotation
+    the angles are equally spaced by 360/nproj_per_rot, so the coverage only depends
+    on the radical inverse offsets of the first nrot rotations.
+
+    Parameters
+    ----------
+    primes : array_like
+        Candidate prime sequence indices
+    nproj_per_rots : array_like
+        Candidate numbers of projections in each rotation
+    nrot : int
+        Number of rotations to evaluate
+
+    Returns
+    -------
+    result : ndarray
+        Structured array with one entry per candidate, best first, with fields
+
+        - prime, nproj_per_rot : the candidate parameters
+        - max_gap : largest angular gap in deg left after each of the nrot rotations
+        - mean_gap : max_gap averaged over the nrot rotations
+        - relative_gap : mean_gap in angular steps (360/nproj_per_rot), used for ranking
+        - uniformity : ideal gap / max_gap after nrot rotations, 1 is perfectly uniform
+        - score : uniformity averaged over the nrot rotations
+        - min_distance : smallest angle in deg between consecutive projections
+
+        Candidates are ranked on relative_gap, then on min_distance in angular
+        steps. Both are normalized by the step of the candidate: the absolute
+        gaps of a larger nproj_per_rot are smaller by construction, which says
+        nothing about how well it interlaces. relative_gap only depends on the
+        prime, nproj_per_rot then ranks on how far apart consecutive projections
+        are relative to its step, and at equal values the larger nproj_per_rot,
+        whose absolute gaps are finer, comes first.
+    """
+
+    primes = np.unique(np.atleast_1d(primes))
+    nproj_per_rots = np.unique(np.atleast_1d(nproj_per_rots))
+
+    # offsets of the first nrot rotations as a fraction of the angular step, shape (prime, rotation)
+    offset = radical_inverse(np.arange(nrot)[np.newaxis], primes[:, np.newaxis])
+
+    # gaps left after each rotation: pad the rotations not done yet with 1 (= 0 of the next step),
+    # offset[0] is always 0 so the padding also closes the wrap around gap
+    done = np.tri(nrot, dtype=bool)
+    covered = np.where(done, offset[:, np.newaxis, :], 1.0)
+    covered = np.concatenate((np.sort(covered, axis=-1), np.ones(covered.shape[:-1] + (1,))), axis=-1)
+    gap = np.max(np.diff(covered, axis=-1), axis=-1)
+    uniformity = 1 / (np.arange(1, nrot + 1) * gap)
+
+    # consecutive projections are one step apart except across rotations
+    step = 360.0 / nproj_per_rots
+    jump = np.mod((np.diff(offset, axis=-1)[:, np.newaxis, :] + 1) * step[np.newaxis, :, np.newaxis], 360.0)
+    jump = np.min(np.minimum(jump, 360.0 - jump), axis=-1, initial=360.0)
+    min_distance = np.where(nproj_per_rots > 1, np.minimum(jump, step), jump)
+
+    result = np.zeros((len(primes), len(nproj_per_rots)), dtype=[('prime', int), ('nproj_per_rot', int),
+        ('max_gap', float, (nrot,)), ('mean_gap', float), ('relative_gap', float), ('uniformity', float),
+        ('score', float),
+        ('min_distance', float)])
+    result['prime'] = primes[:, np.newaxis]
+    result['nproj_per_rot'] = nproj_per_rots
+    result['max_gap'] = gap[:, np.newaxis, :] * step[np.newaxis, :, np.newaxis]
+    result['mean_gap'] = np.mean(result['max_gap'], axis=-1)
+    result['relative_gap'] = np.mean(gap, axis=-1)[:, np.newaxis]
+    result['uniformity'] = uniformity[:, np.newaxis, -1]
+    result['score'] = np.mean(uniformity, axis=-1)[:, np.newaxis]
+    result['min_distance'] = min_distance
+    result = result.ravel()
+
+    relative_distance = result['min_distance'] * result['nproj_per_rot'] / 360.0
+    return result[np.lexsort((-result['nproj_per_rot'], -relative_distance, result['relative_gap']))]
 
-    if continuous_angle:
-        j = 0
-        for x in range(len(seq)):       
-            if (x%nproj_per_rot == 0):
-                for y in range(nproj_per_rot):
-                    if (x+y) < len(seq):
-                        seq[x+y] += j*360.0
-                j += 1
 
-    return np.array(seq)
+def _int_range(value):
+    """argparse type accepting an int or a first:last range"""
+
+    first, _, last = value.partition(':')
+    return list(range(int(first), int(last or first) + 1))
+
+
+def _prime_range(value):
+    """argparse type accepting a prime or a first:last range, of which only the primes are kept"""
+
+    values = _int_range(value)
+    primes = [n for n in values if n >= 2 and all(n % d for d in range(2, int(n ** 0.5) + 1))]
+    if ':' not in value and not primes:
+        raise argparse.ArgumentTypeError('%s is not a prime' % value)
+    return primes
+
 
 def main(arg):
 
@@ -65,7 +241,22 @@ def main(arg):
     parser.add_argument("--prime", nargs='?', type=int, default=10, help="prime: 3 (default 3). Ratio to position the first angle past 360")
     parser.add_argument("--continuous_angle",action="store_true", help="set to generate continuous angles past 360 deg")
 
-    args = parser.parse_args()
+    subparsers = parser.add_subparsers(dest='command')
+    sweep_parser = subparsers.add_parser('sweep', help="rank (prime, nproj_per_rot) candidates by angular coverage")
+    sweep_parser.add_argument("--primes", nargs='+', type=_prime_range, default=[_prime_range('2:31')], help="primes or first:last ranges of primes: 2:31 (default 2:31)")
+    sweep_parser.add_argument("--nproj_per_rots", nargs='+', type=_int_range, default=[[10]], help="projections per rotation or first:last ranges: 10 (default 10)")
+    sweep_parser.add_argument("--nrot", type=int, default=16, help="number of rotations to evaluate: 16 (default 16)")
+    sweep_parser.add_argument("--top", type=int, default=10, help="number of candidates to print: 10 (default 10)")
+
+    args = parser.parse_args(arg)
+
+    if args.command == 'sweep':
+        result = interlace_sweep(np.concatenate(args.primes), np.concatenate(args.nproj_per_rots), args.nrot)
+        print('%6s %14s %12s %12s %12s %12s %10s %14s' % ('prime', 'nproj_per_rot', 'relative_gap', 'mean_gap', 'max_gap', 'uniformity', 'score', 'min_distance'))
+        for r in result[:args.top]:
+            print('%6d %14d %12.4f %12.4f %12.4f %12.4f %10.4f %14.4f' % (r['prime'], r['nproj_per_rot'], r['relative_gap'],
+                r['mean_gap'], r['max_gap'][-1], r['uniformity'], r['score'], r['min_distance']))
+        return
 
     nproj_total = args.nproj_total
     nproj_per_rot = args.nproj_per_rot
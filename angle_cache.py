@@ -0,0 +1,130 @@
+'''
+    Memoized interlaced angle sequences
+
+    Sequences are kept in an in-process LRU and stored as .npy files that
+    are memory-mapped when loaded again, so repeated scan plans neither
+    recompute nor copy the angles.
+'''
+import os
+import glob
+import threading
+import collections
+import numpy as np
+
+import angle
+
+CACHE_DIR = os.path.join(os.path.expanduser('~'), '.cache', 'interlaced_angles')
+
+
+class AngleCache():
+    """Two tier cache for angle.interlaced_angle_sequence()
+
+    Parameters
+    ----------
+    cache_dir : str
+        Directory for the .npy files. None to keep the sequences in memory only
+    max_memory : int
+        Maximum number of bytes held by the in-process LRU
+    max_disk : int
+        Maximum number of bytes of .npy files in cache_dir
+    version : int
+        Algorithm version stored in the keys, entries of other versions are never used
+    """
+
+    def __init__(self, cache_dir=CACHE_DIR, max_memory=256*2**20, max_disk=4*2**30, version=angle.ALGORITHM_VERSION):
+        self.cache_dir = cache_dir
+        self.max_memory = max_memory
+        self.max_disk = max_disk
+        self.version = version
+        self.memory = collections.OrderedDict()
+        self.memory_size = 0
+        self.lock = threading.Lock()
+        if cache_dir is not None:
+            os.makedirs(cache_dir, exist_ok=True)
+
+    def get(self, nproj_total, nproj_per_rot, prime, continuous_angle=True):
+        """Return the interlaced angle sequence, computing it only on a cache miss
+
+        The returned array is read-only and shared between callers.
+        """
+
+        key = (self.version, int(nproj_total), int(nproj_per_rot), int(prime), bool(continuous_angle))
+        with self.lock:
+            theta = self.memory.get(key)
+            if theta is not None:
+                self.memory.move_to_end(key)
+                return theta
+
+            fname = self._file_name(key)
+            if fname is not None and os.path.exists(fname):
+                theta = np.load(fname, mmap_mode='r')
+                os.utime(fname)
+            else:
+                theta = angle.interlaced_angle_sequence(nproj_total, nproj_per_rot, prime, continuous_angle)
+                if fname is not None and theta.size > 0:
+                    # write and rename so a concurrent reader never maps a partial file
+                    tmp_fname = '%s.%d.tmp' % (fname, os.getpid())
+                    with open(tmp_fname, 'wb') as fid:
+                        np.save(fid, theta)
+                    os.replace(tmp_fname, fname)
+                    self._evict_disk()
+                    theta = np.load(fname, mmap_mode='r')
+                theta.flags.writeable = False
+
+            self.memory[key] = theta
+            self.memory_size += theta.nbytes
+            self._evict_memory()
+            return theta
+
+    def invalidate(self, all_versions=False):
+        """Drop the cached sequences of other algorithm versions, or all of them
+
+        Returns
+        -------
+        int
+            Number of .npy files removed
+        """
+
+        with self.lock:
+            self.memory.clear()
+            self.memory_size = 0
+            if self.cache_dir is None:
+                return 0
+            removed = 0
+            for fname in glob.glob(os.path.join(self.cache_dir, 'v*.npy')):
+                if all_versions or not os.path.basename(fname).startswith('v%d_' % self.version):
+                    os.remove(fname)
+                    removed += 1
+            return removed
+
+    def _file_name(self, key):
+        if self.cache_dir is None:
+            return None
+        return os.path.join(self.cache_dir, 'v%d_%d_%d_%d_%d.npy' % key)
+
+    def _evict_memory(self):
+        while self.memory_size > self.max_memory and len(self.memory) > 1:
+            _, theta = self.memory.popitem(last=False)
+            self.memory_size -= theta.nbytes
+
+    def _evict_disk(self):
+        # least recently used first, get() touches the files it loads
+        files = [(os.stat(fname), fname) for fname in glob.glob(os.path.join(self.cache_dir, 'v*.npy'))]
+        files.sort(key=lambda f: f[0].st_mtime)
+        disk_size = sum(stat.st_size for stat, _ in files)
+        for stat, fname in files[:-1]:
+            if disk_size <= self.max_disk:
+                break
+            os.remove(fname)
+            disk_size -= stat.st_size
+
+
+_cache = None
+
+def interlaced_angle_sequence(nproj_total, nproj_per_rot, prime, continuous_angle=True):
+    """Cached version of angle.interlaced_angle_sequence() using a process wide AngleCache"""
+
+    global _cache
+    if _cache is None:
+        _cache = AngleCache()
+    return _cache.get(nproj_total, nproj_per_rot, prime, continuous_angle)
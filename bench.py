@@ -0,0 +1,281 @@
+'''
+    Scan setup latency benchmark
+
+    Runs set_pso, set_trigger_mode, open_shutter/close_shutter and the trigger_mode
+    scan cycle against the simulated IOC and reports p50/p95/p99 of the total time
+    and of every individual put and wait.
+
+    python bench.py -n 20 --latency 0.005 -o new.json --compare old.json
+'''
+import sys
+import time
+import json
+import argparse
+import threading
+import collections
+
+import numpy as np
+
+import sim_ioc
+
+PERCENTILES = (50, 95, 99)
+
+
+class Trace():
+    """Collects the timing of the puts and waits issued during one operation"""
+
+    def __init__(self):
+        self.lock = threading.Condition()
+        self.events = []
+        self.pending = collections.Counter()
+
+    def add(self, label, elapsed):
+        with self.lock:
+            self.events.append((label, elapsed))
+
+    def start_put(self, label):
+        with self.lock:
+            self.pending[label] += 1
+
+    def end_put(self, label, elapsed):
+        with self.lock:
+            self.pending[label] -= 1
+            self.events.append((label, elapsed))
+            self.lock.notify_all()
+
+    def settle(self, timeout):
+        """Waits for the puts still in progress, returns the labels of those that did not complete"""
+
+        with self.lock:
+            self.lock.wait_for(lambda: sum(self.pending.values()) == 0, timeout)
+            return [label for label, count in self.pending.items() for _ in range(count)]
+
+
+_trace = None
+
+
+def _traced_put(put):
+    """Wraps SimIOC.put to time each put from the request to its completion"""
+
+    def traced(name, value, complete):
+        trace = _trace
+        if trace is None:
+            return put(name, value, complete)
+        label = 'put ' + name
+        start_time = time.time()
+        trace.start_put(label)
+
+        def traced_complete():
+            trace.end_put(label, time.time() - start_time)
+            complete()
+        return put(name, value, traced_complete)
+    return traced
+
+
+def _traced(label, function):
+    """Wraps a blocking helper (wait_all, put_all, ...) to time each call"""
+
+    def traced(*args, **kwargs):
+        trace = _trace
+        start_time = time.time()
+        try:
+            return function(*args, **kwargs)
+        finally:
+            if trace is not None:
+                trace.add(label(*args, **kwargs), time.time() - start_time)
+    return traced
+
+
+def _wait_label(conditions, *args, **kwargs):
+    return 'wait ' + ','.join(condition[0].pvname for condition in conditions)
+
+
+def _put_all_label(puts, *args, **kwargs):
+    return 'put_all ' + ','.join(epics_pv.pvname for epics_pv, _ in puts)
+
+
+def install_tracing(ioc):
+    """Times every put of the IOC and every wait_all/put_all/wait_camera_done call"""
+
+    import pv_util
+    import trigger_mode
+    import shutter
+
+    ioc.put = _traced_put(ioc.put)
+    # wait_pv goes through pv_util.wait_all, the modules below imported the names directly
+    for module in (pv_util, trigger_mode):
+        if hasattr(module, 'wait_all'):
+            module.wait_all = _traced(_wait_label, module.wait_all)
+        if hasattr(module, 'put_all'):
+            module.put_all = _traced(_put_all_label, module.put_all)
+    trigger_mode.wait_camera_done = _traced(lambda *args, **kwargs: 'wait_camera_done',
+                                            trigger_mode.wait_camera_done)
+    return trigger_mode, shutter
+
+
+def stats(values):
+    """p50/p95/p99, mean, min and max of a list of seconds"""
+
+    values = np.asarray(values, dtype=float)
+    if len(values) == 0:
+        return {}
+    result = {'p%d' % q: float(v) for q, v in zip(PERCENTILES, np.percentile(values, PERCENTILES))}
+    result.update(mean=float(values.mean()), min=float(values.min()), max=float(values.max()),
+                  count=int(len(values)))
+    return result
+
+
+def run_operation(name, function, n, settle=0.2):
+    """Runs function(i) for i in range(n), returns the total times and the breakdown
+
+    The breakdown lists, for each put or wait label, the statistics of the
+    individual calls and the average time per run spent in it. Puts that did not
+    complete within settle seconds after the end of a run (e.g. the camera
+    Acquire left running) are counted as incomplete.
+    """
+
+    global _trace
+    totals = []
+    events = collections.defaultdict(list)
+    incomplete = collections.Counter()
+    for i in range(n):
+        trace = Trace()
+        _trace = trace
+        start_time = time.time()
+        try:
+            function(i)
+        finally:
+            totals.append(time.time() - start_time)
+            _trace = None
+        incomplete.update(trace.settle(settle))
+        with trace.lock:
+            for label, elapsed in trace.events:
+                events[label].append(elapsed)
+
+    total_stats = stats(totals)
+    breakdown = {}
+    for label, elapsed in sorted(events.items(), key=lambda item: -sum(item[1])):
+        breakdown[label] = stats(elapsed)
+        breakdown[label]['per_run'] = float(sum(elapsed) / n)
+        breakdown[label]['share'] = float(sum(elapsed) / sum(totals)) if sum(totals) > 0 else 0.0
+        breakdown[label]['incomplete'] = incomplete.pop(label, 0)
+    for label, count in incomplete.items():
+        breakdown[label] = {'count': 0, 'per_run': 0.0, 'share': 0.0, 'incomplete': count}
+    print('%-24s p50 %8.4f  p95 %8.4f  p99 %8.4f  max %8.4f s' % (
+        name, total_stats['p50'], total_stats['p95'], total_stats['p99'], total_stats['max']))
+    return {'runs': totals, 'stats': total_stats, 'breakdown': breakdown}
+
+
+def show_breakdown(results, top=8):
+    for name, result in results['operations'].items():
+        print('%s' % name)
+        for label, s in list(result['breakdown'].items())[:top]:
+            if s['count'] == 0:
+                print('    %-60s incomplete %d' % (label[:60], s['incomplete']))
+                continue
+            print('    %-60s n/run %5.1f  p50 %8.4f  p99 %8.4f  %5.1f%%' % (
+                label[:60], s['count'] / len(result['runs']), s['p50'], s['p99'], 100 * s['share']))
+
+
+def compare(old, new, threshold=0.2):
+    """Compares two result files, returns the operations slower by more than threshold
+
+    An operation regresses when its p50 or p99 is more than threshold (relative)
+    above the old value.
+    """
+
+    regressions = []
+    changed = sorted(key for key in new['config'] if old['config'].get(key) != new['config'][key]
+                     and key not in ('threshold', 'num_runs', 'operations'))
+    if changed:
+        print('warning: runs with a different configuration: %s' % ' '.join(changed))
+    print('%-24s %10s %10s %8s %10s %10s %8s' % ('operation', 'old p50', 'new p50', 'ratio', 'old p99', 'new p99', 'ratio'))
+    for name, result in new['operations'].items():
+        if name not in old['operations']:
+            continue
+        a = old['operations'][name]['stats']
+        b = result['stats']
+        r50 = b['p50'] / a['p50'] if a['p50'] > 0 else float('inf')
+        r99 = b['p99'] / a['p99'] if a['p99'] > 0 else float('inf')
+        flag = ''
+        if r50 > 1 + threshold or r99 > 1 + threshold:
+            regressions.append(name)
+            flag = '  REGRESSION'
+        print('%-24s %10.4f %10.4f %8.2f %10.4f %10.4f %8.2f%s' % (name, a['p50'], b['p50'], r50, a['p99'], b['p99'], r99, flag))
+    return regressions
+
+
+def main(arg):
+
+    parser = argparse.ArgumentParser(description="benchmark the scan setup against the simulated IOC")
+    parser.add_argument("-n", "--num_runs", type=int, default=10, help="runs per operation: 10 (default 10)")
+    parser.add_argument("--latency", type=float, default=0.001, help="put latency in s: 0.001 (default 0.001)")
+    parser.add_argument("--pso_latency", type=float, default=None, help="put latency in s of the PSOFly2 PVs (default --latency)")
+    parser.add_argument("--camera_latency", type=float, default=None, help="put latency in s of the camera PVs (default --latency)")
+    parser.add_argument("--slew_speed", type=float, default=5.0, help="fly scan speed in deg/s: 5 (default 5)")
+    parser.add_argument("--taxi_time", type=float, default=0.1, help="taxi time in s: 0.1 (default 0.1)")
+    parser.add_argument("--shutter_time", type=float, default=0.1, help="shutter status latency in s: 0.1 (default 0.1)")
+    parser.add_argument("--num_angles", type=int, default=100, help="projections of the scan cycle: 100 (default 100)")
+    parser.add_argument("--rotation_step", type=float, default=0.1, help="rotation step in deg: 0.1 (default 0.1)")
+    parser.add_argument("--operations", nargs='+', default=None,
+                        help="operations to run (default all): set_pso set_trigger_mode shutter scan_cycle")
+    parser.add_argument("-o", "--output", default='bench.json', help="JSON result file (default bench.json)")
+    parser.add_argument("--compare", default=None, help="JSON result file of a previous run to compare with")
+    parser.add_argument("--threshold", type=float, default=0.2, help="relative slowdown flagged as regression: 0.2 (default 0.2)")
+
+    args = parser.parse_args(arg)
+
+    latencies = {}
+    if args.pso_latency is not None:
+        latencies[sim_ioc.PSO_PREFIX] = args.pso_latency
+    if args.camera_latency is not None:
+        latencies[sim_ioc.CAMERA_PREFIX] = args.camera_latency
+    ioc = sim_ioc.install(sim_ioc.SimIOC(args.latency, latencies, args.slew_speed, args.taxi_time,
+                                         args.shutter_time))
+    trigger_mode, shutter = install_tracing(ioc)
+
+    epics_pvs = trigger_mode.set_pvs()
+    camera_state = trigger_mode.CameraState(epics_pvs)
+    shutter_pvs = shutter.set_pvs()
+    num_angles = args.num_angles
+    rotation_step = args.rotation_step
+
+    operations = collections.OrderedDict()
+    # set_pso alternates the start position, rewriting the same values would not wait on the IOC
+    operations['set_pso'] = lambda i: trigger_mode.set_pso(epics_pvs, i % 2, num_angles, rotation_step)
+    operations['set_trigger_mode'] = lambda i: (
+        trigger_mode.set_trigger_mode(epics_pvs, 'PSOExternal', num_angles, camera_state),
+        trigger_mode.set_trigger_mode(epics_pvs, 'FreeRun', 1, camera_state))
+    operations['shutter'] = lambda i: (shutter.open_shutter(shutter_pvs), shutter.close_shutter(shutter_pvs))
+    operations['scan_cycle'] = lambda i: trigger_mode.scan_cycle(epics_pvs, 0, num_angles, rotation_step,
+                                                               camera_state)
+    if args.operations is not None:
+        unknown = set(args.operations) - set(operations)
+        if unknown:
+            parser.error('unknown operations: %s' % ' '.join(sorted(unknown)))
+        operations = collections.OrderedDict((name, operations[name]) for name in args.operations)
+
+    results = {'config': {key: value for key, value in vars(args).items() if key not in ('output', 'compare')},
+               'operations': collections.OrderedDict()}
+    for name, function in operations.items():
+        results['operations'][name] = run_operation(name, function, args.num_runs)
+    print()
+    show_breakdown(results)
+
+    with open(args.output, 'w') as fid:
+        json.dump(results, fid, indent=2)
+    print('results saved in %s' % args.output)
+
+    if args.compare is not None:
+        with open(args.compare) as fid:
+            old = json.load(fid)
+        print()
+        regressions = compare(old, results, args.threshold)
+        if regressions:
+            print('regressions: %s' % ' '.join(regressions))
+            return 1
+    return 0
+
+
+if __name__ == "__main__":
+    sys.exit(main(sys.argv[1:]))
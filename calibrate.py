@@ -0,0 +1,172 @@
+'''
+    Minimum frame time calibration for PSO triggered acquisition
+
+    Runs short PSO fly scans at decreasing trigger periods, bisects the smallest
+    period at which the camera drops no frame and stores it in
+    ~/.config/frame_time_calibration.json for the camera model, pixel format,
+    video mode, binning and exposure. compute_frame_time() then uses it.
+
+        python calibrate.py --num_angles 200
+        python sim_ioc.py calibrate.py --num_angles 200
+'''
+import sys
+import argparse
+
+import log
+import trigger_mode
+from trigger_mode import set_pvs, set_pso, set_trigger_mode, wait_camera_done, camera_identity, CameraState
+from pv_util import wait_pv
+from drop_detector import DropDetector
+from camera_readout import get_calibration
+
+
+def run_trial(epics_pvs, frame_time, num_triggers, rotation_step, camera_state=None):
+    """Runs one PSO fly scan with a trigger every frame_time seconds
+
+    The PSO must already be set up with rotation_step and num_triggers.
+
+    Returns
+    -------
+    int
+        Number of dropped frames
+    """
+
+    epics_pvs['PSOslewSpeed'].put(rotation_step / frame_time, wait=True)
+    epics_pvs['PSOtaxi'].put(1, wait=True)
+    wait_pv(epics_pvs['PSOtaxi'], 0)
+    set_trigger_mode(epics_pvs, 'PSOExternal', num_triggers, camera_state)
+    epics_pvs['CamAcquire'].put('Acquire')
+    wait_pv(epics_pvs['CamAcquire'], 1)
+
+    detector = DropDetector(epics_pvs, num_triggers, frame_time, frame_time)
+    detector.start()
+    epics_pvs['PSOfly'].put(1)
+    # a camera that dropped frames keeps waiting for them, stop it after the fly
+    camera_done = wait_camera_done(epics_pvs, num_triggers * frame_time + 1.0, num_triggers)
+    drops = detector.stop()
+    if not camera_done.done:
+        epics_pvs['CamAcquire'].put('Done')
+        wait_pv(epics_pvs['CamAcquire'], 0, 5)
+    wait_pv(epics_pvs['PSOfly'], 0, 10)
+    log.info('frame time %.6f s: %d dropped frames', frame_time, drops.dropped)
+    return drops.dropped
+
+
+def calibrate_frame_time(epics_pvs, camera_state=None, num_angles=200, rotation_step=0.1, decrease=0.8,
+                         resolution=1e-4, repeats=2, max_trials=30):
+    """Bisects the smallest frame time with no dropped frame
+
+    Starting from compute_frame_time(), the frame time is first raised until a
+    trial drops nothing, then lowered by the decrease factor until one drops
+    frames, and the interval between the two is bisected down to resolution.
+    The last passing frame time is confirmed by repeats trials.
+
+    Parameters
+    ----------
+    num_angles, rotation_step : int, float
+        PSO scan of each trial, the trial takes about num_angles frame times
+    decrease : float
+        Factor applied to the frame time while looking for a failing one
+    resolution : float
+        Width in s of the final bisection interval
+    repeats : int
+        Trials the result must pass without a dropped frame
+    max_trials : int
+        Maximum number of trials
+
+    Returns
+    -------
+    float
+        Smallest frame time in s without dropped frames, None if none was found
+        or if max_trials ran out before it passed the repeats confirmation
+    """
+
+    camera = camera_identity(epics_pvs)
+    slew_speed = epics_pvs['PSOslewSpeed'].get()
+    set_pso(epics_pvs, 0, num_angles, rotation_step)
+    num_triggers = int(epics_pvs['PSOcalcProjections'].get())
+    calc_rotation_step = epics_pvs['PSOscanDelta'].get()
+    start_frame_time = trigger_mode.compute_frame_time(epics_pvs)
+    log.info('calibrating %s %s exposure %.6f s from %.6f s', camera.model, camera.pixel_format, camera.exposure,
+             start_frame_time)
+
+    trials = [0]
+
+    def passes(frame_time, times=1):
+        for _ in range(times):
+            trials[0] += 1
+            if run_trial(epics_pvs, frame_time, num_triggers, calc_rotation_step, camera_state) > 0:
+                return False
+        return True
+
+    try:
+        frame_time = start_frame_time
+        while not passes(frame_time):
+            if trials[0] >= max_trials:
+                log.error('  *** no frame time without dropped frames found')
+                return None
+            frame_time /= decrease
+        good = frame_time
+        bad = camera.exposure
+        frame_time = good * decrease
+        while trials[0] < max_trials and frame_time > camera.exposure:
+            if not passes(frame_time):
+                bad = frame_time
+                break
+            good = frame_time
+            frame_time *= decrease
+        while trials[0] < max_trials and good - bad > resolution:
+            frame_time = (good + bad) / 2
+            if passes(frame_time):
+                good = frame_time
+            else:
+                bad = frame_time
+        # confirm the result, back off if it does not hold
+        confirmed = False
+        while trials[0] < max_trials:
+            if passes(good, repeats):
+                confirmed = True
+                break
+            good += resolution
+    finally:
+        epics_pvs['PSOslewSpeed'].put(slew_speed, wait=True)
+        set_trigger_mode(epics_pvs, 'FreeRun', 1, camera_state)
+
+    if not confirmed:
+        log.error('  *** %.6f s not confirmed by %d trials after %d trials, increase max_trials',
+                  good, repeats, trials[0])
+        return None
+    log.info('minimum frame time %.6f s (was %.6f s) after %d trials', good, start_frame_time, trials[0])
+    return good
+
+
+def main(arg):
+
+    parser = argparse.ArgumentParser(description="calibrate the minimum frame time of PSO triggered acquisition")
+    parser.add_argument("--num_angles", type=int, default=200, help="triggers per trial: 200 (default 200)")
+    parser.add_argument("--rotation_step", type=float, default=0.1, help="rotation step in deg: 0.1 (default 0.1)")
+    parser.add_argument("--resolution", type=float, default=1e-4, help="frame time resolution in s: 0.0001 (default 0.0001)")
+    parser.add_argument("--repeats", type=int, default=2, help="trials the result must pass: 2 (default 2)")
+    parser.add_argument("--max_trials", type=int, default=30, help="maximum number of trials: 30 (default 30)")
+    parser.add_argument("--dry_run", action="store_true", help="do not store the result")
+
+    args = parser.parse_args(arg)
+    log.setup_custom_logger()
+
+    epics_pvs = set_pvs()
+    camera_state = CameraState(epics_pvs)
+    camera = camera_identity(epics_pvs)
+    frame_time = calibrate_frame_time(epics_pvs, camera_state, args.num_angles, args.rotation_step,
+                                      resolution=args.resolution, repeats=args.repeats,
+                                      max_trials=args.max_trials)
+    if frame_time is None or args.dry_run:
+        return
+    calibration = get_calibration()
+    calibration.add(camera.model, camera.pixel_format, camera.exposure, frame_time, camera.video_mode,
+                    camera.binning)
+    calibration.save()
+    log.info('saved in %s', calibration.file_name)
+
+
+if __name__ == "__main__":
+    main(sys.argv[1:])
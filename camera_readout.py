@@ -0,0 +1,298 @@
+'''
+    Camera readout time registry
+
+    Readout times are loaded from camera_readout.json, next to this file, and from
+    ~/.config/camera_readout.json if it exists, whose entries take precedence. A new
+    detector only needs entries in one of these files:
+
+        {"model": "Oryx ORX-10G-51S5M", "pixel_format": "Mono8", "video_mode": null,
+         "binning": [1, 1], "readout_ms": 6.18}
+
+    Missing combinations are interpolated from the entries of the same model.
+'''
+import os
+import json
+import threading
+
+import numpy as np
+
+import log
+
+REGISTRY_FILE = os.path.join(os.path.dirname(os.path.abspath(__file__)), 'camera_readout.json')
+USER_REGISTRY_FILE = os.path.join(os.path.expanduser('~'), '.config', 'camera_readout.json')
+CALIBRATION_FILE = os.path.join(os.path.expanduser('~'), '.config', 'frame_time_calibration.json')
+
+# bits per pixel of the pixel formats, the axis used to interpolate between formats
+BITS_PER_PIXEL = {
+    'Mono8': 8, 'Mono10Packed': 10, 'Mono10p': 10, 'Mono12Packed': 12, 'Mono12p': 12,
+    'Mono12': 16, 'Mono14': 16, 'Mono16': 16,
+}
+
+_registry = None
+_calibration = None
+
+
+class ReadoutRegistry():
+    """Camera readout times keyed by model, pixel format, video mode and binning
+
+    Parameters
+    ----------
+    file_names : list of str
+        JSON files to load, later files override the entries of earlier ones,
+        missing files are skipped
+    """
+
+    def __init__(self, file_names=(REGISTRY_FILE, USER_REGISTRY_FILE)):
+        # (model, pixel_format, video_mode, (binx, biny)) -> readout in s
+        self.entries = {}
+        for file_name in file_names:
+            if os.path.exists(file_name):
+                self.load(file_name)
+
+    def load(self, file_name):
+        with open(file_name) as fid:
+            for entry in json.load(fid)['cameras']:
+                self.add(entry['model'], entry['pixel_format'], entry['readout_ms'] / 1000.,
+                         entry.get('video_mode'), entry.get('binning', (1, 1)))
+
+    def save(self, file_name):
+        """Writes all the entries to a JSON file in the format read by load()"""
+
+        entries = [{'model': model, 'pixel_format': pixel_format, 'video_mode': video_mode,
+                    'binning': list(binning), 'readout_ms': round(readout * 1000., 6)}
+                   for (model, pixel_format, video_mode, binning), readout in sorted(
+                       self.entries.items(), key=lambda item: tuple(str(v) for v in item[0]))]
+        with open(file_name, 'w') as fid:
+            fid.write('{\n "cameras": [\n%s\n ]\n}\n' % ',\n'.join('  ' + json.dumps(entry) for entry in entries))
+
+    def add(self, model, pixel_format, readout, video_mode=None, binning=(1, 1)):
+        """Adds or replaces the readout time in s of a camera configuration"""
+
+        self.entries[(model, pixel_format, video_mode, tuple(int(b) for b in binning))] = float(readout)
+
+    def models(self):
+        return sorted(set(key[0] for key in self.entries))
+
+    def has_video_modes(self, model):
+        """True if the readout of model depends on the video mode, i.e. the camera has a VideoMode PV"""
+
+        return any(key[0] == model and key[2] is not None for key in self.entries)
+
+    def lookup(self, model, pixel_format, video_mode=None, binning=(1, 1)):
+        """Readout time in s of a camera configuration, None for an unknown model
+
+        Without an exact entry, or one for any video mode, the entries of the
+        model are used: with the same video mode if there are some, otherwise
+        all of them, keeping the slowest. They are interpolated over the bits
+        per pixel of the pixel format and then over the number of pixels read,
+        i.e. 1 / (binx * biny); values outside the known range are clamped.
+        """
+
+        binning = tuple(int(b) for b in binning)
+        for mode in (video_mode, None):
+            readout = self.entries.get((model, pixel_format, mode, binning))
+            if readout is not None:
+                return readout
+
+        entries = [(key, readout) for key, readout in self.entries.items() if key[0] == model]
+        if not entries:
+            return None
+        same_mode = [(key, readout) for key, readout in entries if key[2] in (video_mode, None)]
+        if same_mode:
+            return self._interpolate(same_mode, pixel_format, binning)
+        modes = set(key[2] for key, _ in entries)
+        return max(self._interpolate([(key, readout) for key, readout in entries if key[2] == mode],
+                                     pixel_format, binning) for mode in modes)
+
+    @staticmethod
+    def _interpolate(entries, pixel_format, binning):
+        bits = BITS_PER_PIXEL.get(pixel_format)
+        by_binning = {}
+        for (_, entry_format, _, entry_binning), readout in entries:
+            by_binning.setdefault(entry_binning, {})
+            # the slowest entry when several video modes give the same format
+            by_binning[entry_binning][entry_format] = max(readout, by_binning[entry_binning].get(entry_format, 0))
+
+        fractions, readouts = [], []
+        for entry_binning, formats in by_binning.items():
+            if pixel_format in formats:
+                readout = formats[pixel_format]
+            else:
+                known = sorted((BITS_PER_PIXEL[name], value) for name, value in formats.items()
+                               if name in BITS_PER_PIXEL)
+                if bits is None or not known:
+                    # unknown bit depth, be conservative
+                    readout = max(formats.values())
+                else:
+                    readout = float(np.interp(bits, [k[0] for k in known], [k[1] for k in known]))
+            fractions.append(1. / (entry_binning[0] * entry_binning[1]))
+            readouts.append(readout)
+        order = np.argsort(fractions)
+        return float(np.interp(1. / (binning[0] * binning[1]), np.array(fractions)[order],
+                               np.array(readouts)[order]))
+
+
+def get_registry():
+    """Process-wide ReadoutRegistry loaded from REGISTRY_FILE and USER_REGISTRY_FILE"""
+
+    global _registry
+    if _registry is None:
+        _registry = ReadoutRegistry()
+    return _registry
+
+
+class FrameTimeCalibration():
+    """Measured minimum frame times keyed by camera configuration and exposure
+
+    Written by calibrate.py, which bisects the smallest trigger period with no
+    dropped frame. For an exposure that was not calibrated but lies between two
+    calibrated ones the overhead above the exposure (frame time - exposure) is
+    interpolated between them, for the same model, pixel format, video mode and
+    binning.
+
+    Parameters
+    ----------
+    file_name : str
+        JSON file, created by save() if it does not exist
+    """
+
+    def __init__(self, file_name=CALIBRATION_FILE):
+        self.file_name = file_name
+        # (model, pixel_format, video_mode, (binx, biny)) -> {exposure: frame_time}
+        self.entries = {}
+        if os.path.exists(file_name):
+            with open(file_name) as fid:
+                for entry in json.load(fid)['calibrations']:
+                    self.add(entry['model'], entry['pixel_format'], entry['exposure'], entry['frame_time'],
+                             entry.get('video_mode'), entry.get('binning', (1, 1)))
+
+    def add(self, model, pixel_format, exposure, frame_time, video_mode=None, binning=(1, 1)):
+        key = (model, pixel_format, video_mode, tuple(int(b) for b in binning))
+        self.entries.setdefault(key, {})[round(float(exposure), 9)] = float(frame_time)
+
+    def save(self):
+        entries = [{'model': model, 'pixel_format': pixel_format, 'video_mode': video_mode,
+                    'binning': list(binning), 'exposure': exposure, 'frame_time': frame_time}
+                   for (model, pixel_format, video_mode, binning), frame_times in sorted(
+                       self.entries.items(), key=lambda item: tuple(str(v) for v in item[0]))
+                   for exposure, frame_time in sorted(frame_times.items())]
+        directory = os.path.dirname(self.file_name)
+        if directory and not os.path.exists(directory):
+            os.makedirs(directory)
+        with open(self.file_name, 'w') as fid:
+            fid.write('{\n "calibrations": [\n%s\n ]\n}\n' % ',\n'.join('  ' + json.dumps(entry) for entry in entries))
+
+    def lookup(self, model, pixel_format, exposure, video_mode=None, binning=(1, 1)):
+        """Calibrated frame time in s, None if the configuration or exposure was not calibrated
+
+        An exposure outside the calibrated ones returns None: the overhead does
+        not extrapolate, e.g. it grows once the readout exceeds the exposure.
+        """
+
+        frame_times = self.entries.get((model, pixel_format, video_mode, tuple(int(b) for b in binning)))
+        if not frame_times:
+            return None
+        exposure = round(float(exposure), 9)
+        if exposure in frame_times:
+            return frame_times[exposure]
+        exposures = sorted(frame_times)
+        if not exposures[0] < exposure < exposures[-1]:
+            return None
+        overheads = [frame_times[e] - e for e in exposures]
+        return exposure + float(np.interp(exposure, exposures, overheads))
+
+
+def get_calibration():
+    """Process-wide FrameTimeCalibration loaded from CALIBRATION_FILE"""
+
+    global _calibration
+    if _calibration is None:
+        _calibration = FrameTimeCalibration()
+    return _calibration
+
+
+class CameraIdentity():
+    """Monitor backed cache of the camera settings that set the frame time
+
+    The readout time is looked up again only when the model, pixel format,
+    video mode or binning change, so compute_frame_time() reads no PV.
+
+    Parameters
+    ----------
+    epics_pvs : dict
+        The dictionary returned by trigger_mode.set_pvs(), without CamVideoMode
+        for a camera that has no video mode
+    registry : ReadoutRegistry
+        None for get_registry()
+    """
+
+    keys = ['CamModel', 'CamPixelFormat', 'CamVideoMode', 'CamBinX', 'CamBinY', 'CamAcquireTimeRBV']
+
+    def __init__(self, epics_pvs, registry=None):
+        self.registry = registry if registry is not None else get_registry()
+        self.lock = threading.Lock()
+        self.values = {}
+        self.cached_readout = None
+        self.stale = True
+        self.values['CamVideoMode'] = None
+        for key in self.keys:
+            if key not in epics_pvs:
+                continue
+            epics_pvs[key].add_callback(self._make_callback(key))
+            value = epics_pvs[key].get(as_string=True) if key in ('CamModel', 'CamPixelFormat', 'CamVideoMode') \
+                else epics_pvs[key].get()
+            self._set(key, value)
+
+    def _make_callback(self, key):
+        def on_change(value=None, char_value=None, **kwargs):
+            self._set(key, char_value if key in ('CamModel', 'CamPixelFormat', 'CamVideoMode') else value)
+        return on_change
+
+    def _set(self, key, value):
+        with self.lock:
+            if key != 'CamAcquireTimeRBV' and self.values.get(key) != value:
+                self.stale = True
+            self.values[key] = value
+
+    @property
+    def model(self):
+        return self.values['CamModel']
+
+    @property
+    def pixel_format(self):
+        return self.values['CamPixelFormat']
+
+    @property
+    def video_mode(self):
+        return self.values['CamVideoMode']
+
+    @property
+    def binning(self):
+        return (int(self.values['CamBinX'] or 1), int(self.values['CamBinY'] or 1))
+
+    @property
+    def exposure(self):
+        """Actual exposure time of the camera in s"""
+
+        return self.values['CamAcquireTimeRBV']
+
+    def calibrated_frame_time(self, calibration=None):
+        """Calibrated frame time in s for the current configuration and exposure, None if not calibrated"""
+
+        calibration = calibration if calibration is not None else get_calibration()
+        with self.lock:
+            return calibration.lookup(self.model, self.pixel_format, self.exposure, self.video_mode,
+                                      self.binning)
+
+    def readout(self):
+        """Readout time in s of the current configuration, None for an unknown camera"""
+
+        with self.lock:
+            if self.stale:
+                self.cached_readout = self.registry.lookup(self.model, self.pixel_format, self.video_mode,
+                                                           self.binning)
+                self.stale = False
+                if self.cached_readout is None:
+                    log.error('Unsupported combination of camera model, pixel format and video mode: %s %s %s',
+                              self.model, self.pixel_format, self.video_mode)
+            return self.cached_readout
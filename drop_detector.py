@@ -0,0 +1,172 @@
+'''
+    Dropped frame detection during PSO fly scans
+
+    Follows the camera NumImagesCounter_RBV during the fly and compares it with the
+    triggers PSOFly2 has issued so far, i.e. one every scanDelta / slewSpeed seconds
+    up to numTriggers. The trigger clock starts at the first frame, as the taxi and the
+    stage acceleration delay the first trigger. A frame is counted as missing once it
+    is later than its trigger period plus a latency, the camera then fell behind; it
+    is no longer counted if it arrives later. A first frame that is dropped is only
+    counted in the total of the report.
+'''
+import time
+import threading
+import collections
+
+import log
+
+MissedWindow = collections.namedtuple('MissedWindow', ['start', 'end', 'missed'])
+DropReport = collections.namedtuple('DropReport', ['num_triggers', 'frames', 'dropped', 'trigger_period',
+                                                   'frame_time', 'windows'])
+
+
+class DropDetector():
+    """Tracks the camera frame counter against the PSO triggers of one fly scan
+
+    Parameters
+    ----------
+    epics_pvs : dict
+        PVs of trigger_mode.set_pvs()
+    num_triggers : int
+        Triggers PSOFly2 issues, i.e. the numTriggers readback
+    trigger_period : float
+        Seconds between two triggers, scanDelta / slewSpeed
+    frame_time : float
+        Seconds the camera needs per frame, e.g. from compute_frame_time()
+    latency : float
+        Seconds a frame may arrive after its expected time
+    tolerance : int
+        Missing frames tolerated before a window is opened
+    sample_interval : float
+        Seconds between two checks, frames also stop arriving when the camera stalls
+    """
+
+    def __init__(self, epics_pvs, num_triggers, trigger_period, frame_time, latency=0.05, tolerance=0,
+                 sample_interval=0.1):
+        self.epics_pvs = epics_pvs
+        self.num_triggers = int(num_triggers)
+        self.trigger_period = trigger_period
+        self.frame_time = frame_time
+        self.latency = latency
+        self.tolerance = tolerance
+        self.sample_interval = sample_interval
+        self.lock = threading.Lock()
+        self.stopped = threading.Event()
+        self.windows = []
+        self.open_window = None
+        self.missed = 0
+        self.frames = 0
+        self.first_frame_time = None
+        self.callback_index = None
+        self.thread = None
+        if trigger_period < frame_time:
+            log.warning('  *** trigger period %.4f s is shorter than the frame time %.4f s, frames will be dropped',
+                        trigger_period, frame_time)
+
+    def expected_frames(self, elapsed):
+        """Frames the camera should have delivered elapsed seconds after its first frame
+
+        The first trigger is taken to be as late as possible, i.e. at the first
+        frame, so frame i is expected i trigger periods plus the latency later.
+        """
+
+        if elapsed < self.latency:
+            return 1
+        return min(self.num_triggers, int((elapsed - self.latency) / self.trigger_period) + 1)
+
+    def start(self):
+        """Starts following the counter, call right before starting the fly"""
+
+        counter = self.epics_pvs['CamNumImagesCounter']
+        self.offset = counter.get()
+        self.start_time = time.time()
+        self.frames = 0
+        self.first_frame_time = None
+        self.callback_index = counter.add_callback(self._on_counter)
+        self.thread = threading.Thread(target=self._sample, name='DropDetector', daemon=True)
+        self.thread.start()
+
+    def _on_counter(self, value=None, **kwargs):
+        now = time.time()
+        with self.lock:
+            self.frames = value - self.offset
+            # the taxi end and the stage acceleration delay the first trigger by
+            # an unknown time, the trigger clock starts with the first frame
+            if self.first_frame_time is None and self.frames > 0:
+                self.first_frame_time = now
+        self._check(now)
+
+    def _sample(self):
+        while not self.stopped.wait(self.sample_interval):
+            self._check(time.time())
+
+    def _check(self, now):
+        # windows follow the current deficit: frames arriving late give back the
+        # frames counted missing, most recent window first
+        with self.lock:
+            if self.first_frame_time is None:
+                return
+            elapsed = now - self.start_time
+            missed = self.expected_frames(now - self.first_frame_time) - self.frames
+            previous = max(self.missed, self.tolerance)
+            if missed > previous:
+                if self.open_window is None:
+                    self.open_window = [elapsed, elapsed, 0]
+                    log.warning('  *** camera behind the PSO triggers at %.3f s: %d frames missing', elapsed, missed)
+                self.open_window[1] = elapsed
+                self.open_window[2] += missed - previous
+            elif missed < previous:
+                self._recover(previous - max(missed, self.tolerance))
+            self.missed = missed
+            if self.open_window is not None and elapsed - self.open_window[1] > 2 * self.trigger_period:
+                self._close_window()
+
+    def _recover(self, frames):
+        if self.open_window is not None:
+            recovered = min(frames, self.open_window[2])
+            self.open_window[2] -= recovered
+            frames -= recovered
+            if self.open_window[2] == 0:
+                self.open_window = None
+        while frames > 0 and self.windows:
+            window = self.windows.pop()
+            recovered = min(frames, window.missed)
+            frames -= recovered
+            if window.missed > recovered:
+                self.windows.append(window._replace(missed=window.missed - recovered))
+
+    def _close_window(self):
+        self.windows.append(MissedWindow(*self.open_window))
+        self.open_window = None
+
+    def stop(self):
+        """Stops following the counter and returns the DropReport of the scan
+
+        The fly is expected to be over, so every trigger should have produced a frame.
+        """
+
+        self.stopped.set()
+        if self.thread is not None:
+            self.thread.join()
+        self.epics_pvs['CamNumImagesCounter'].remove_callback(self.callback_index)
+        with self.lock:
+            first_frame_time = self.first_frame_time
+        if first_frame_time is not None:
+            self._check(max(time.time(), first_frame_time + self.latency
+                            + (self.num_triggers - 1) * self.trigger_period))
+        with self.lock:
+            if self.open_window is not None:
+                self._close_window()
+            frames = self.frames
+        report = DropReport(self.num_triggers, frames, max(self.num_triggers - frames, 0), self.trigger_period,
+                            self.frame_time, list(self.windows))
+        if frames == 0 and self.num_triggers > 0:
+            log.error('  *** no frame received for %d triggers', self.num_triggers)
+        elif report.dropped > 0:
+            log.error('  *** %d of %d frames dropped in %d windows', report.dropped, report.num_triggers,
+                      len(report.windows))
+            for window in report.windows:
+                log.error('  ***   %.3f s - %.3f s: %d frames', window.start, window.end, window.missed)
+        else:
+            log.info('no dropped frames: %d of %d', frames, report.num_triggers)
+        return report
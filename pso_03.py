@@ -1,33 +1,7 @@
 import time
 
-from epics import PV
-
-EPSILON = .001
-
-def wait_pv(epics_pv, wait_val, timeout=-1):
-    """Wait on a pv to be a value until max_timeout (default forever)
-       delay for pv to change
-    """
-
-    time.sleep(.01)
-    start_time = time.time()
-    while True:
-        pv_val = epics_pv.get()
-        if isinstance(pv_val, float):
-            if abs(pv_val - wait_val) < EPSILON:
-                return True
-        if pv_val != wait_val:
-            if timeout > -1:
-                current_time = time.time()
-                diff_time = current_time - start_time
-                if diff_time >= timeout:
-                    log.error('  *** ERROR: DROPPED IMAGES ***')
-                    log.error('  *** wait_pv(%s, %d, %5.2f reached max timeout. Return False',
-                                  epics_pv.pvname, wait_val, timeout)
-                    return False
-            time.sleep(.01)
-        else:
-            return True
+from pv_util import wait_pv, get_pv
+import pso_model
 
 
 def set_pso_not_ok(rotation_start, num_angles, rotation_step):
@@ -37,11 +11,11 @@ def set_pso_not_ok(rotation_start, num_angles, rotation_step):
     control_pvs = {}
     prefix = '2bma:PSOFly2:'
 
-    control_pvs['PSOstartPos']        = PV(prefix + 'startPos')
-    control_pvs['PSOendPos']          = PV(prefix + 'endPos')
-    control_pvs['PSOscanDelta']       = PV(prefix + 'scanDelta')
-    control_pvs['PSOcalcProjections'] = PV(prefix + 'numTriggers')        
-    control_pvs['ThetaArray']         = PV(prefix + 'motorPos.AVAL')
+    control_pvs['PSOstartPos']        = get_pv(prefix + 'startPos')
+    control_pvs['PSOendPos']          = get_pv(prefix + 'endPos')
+    control_pvs['PSOscanDelta']       = get_pv(prefix + 'scanDelta')
+    control_pvs['PSOcalcProjections'] = get_pv(prefix + 'numTriggers')        
+    control_pvs['ThetaArray']         = get_pv(prefix + 'motorPos.AVAL')
 
     control_pvs['PSOstartPos'].put(rotation_start, wait=True)
     wait_pv(control_pvs['PSOstartPos'], rotation_start)
@@ -77,11 +51,11 @@ def set_pso_ok(rotation_start, num_angles, rotation_step):
     control_pvs = {}
     prefix = '2bma:PSOFly2:'
 
-    control_pvs['PSOstartPos']        = PV(prefix + 'startPos')
-    control_pvs['PSOendPos']          = PV(prefix + 'endPos')
-    control_pvs['PSOscanDelta']       = PV(prefix + 'scanDelta')
-    control_pvs['PSOcalcProjections'] = PV(prefix + 'numTriggers')        
-    control_pvs['ThetaArray']         = PV(prefix + 'motorPos.AVAL')
+    control_pvs['PSOstartPos']        = get_pv(prefix + 'startPos')
+    control_pvs['PSOendPos']          = get_pv(prefix + 'endPos')
+    control_pvs['PSOscanDelta']       = get_pv(prefix + 'scanDelta')
+    control_pvs['PSOcalcProjections'] = get_pv(prefix + 'numTriggers')        
+    control_pvs['ThetaArray']         = get_pv(prefix + 'motorPos.AVAL')
 
     control_pvs['PSOstartPos'].put(rotation_start, wait=True)
     wait_pv(control_pvs['PSOstartPos'], rotation_start)
@@ -112,6 +86,37 @@ def set_pso_ok(rotation_start, num_angles, rotation_step):
     theta = control_pvs['ThetaArray'].get(count=int(num_angles))
     print('theta = ', theta)
 
+def set_pso_predicted(rotation_start, num_angles, rotation_step):
+
+    rotation_stop = rotation_start + (rotation_step * num_angles)
+
+    control_pvs = {}
+    prefix = '2bma:PSOFly2:'
+
+    control_pvs['PSOstartPos']        = get_pv(prefix + 'startPos')
+    control_pvs['PSOendPos']          = get_pv(prefix + 'endPos')
+    control_pvs['PSOscanDelta']       = get_pv(prefix + 'scanDelta')
+    control_pvs['PSOcalcProjections'] = get_pv(prefix + 'numTriggers')
+    control_pvs['ThetaArray']         = get_pv(prefix + 'motorPos.AVAL')
+
+    # no endPos re-write and no sleep: each pv is written once and the
+    # readbacks are checked together against the quantization model
+    setup = pso_model.predict(rotation_start, rotation_stop, rotation_step)
+    done, status = pso_model.set_pso_pvs(control_pvs, setup)
+    for pv_status in status:
+        print(pv_status.pvname, 'predicted', pv_status.wait_val, 'matches', pv_status.satisfied, 'put in', pv_status.elapsed, 's')
+    if not done:
+        print('readbacks do not match the predicted', setup)
+
+    print('start entered/predicted', rotation_start, setup.rotation_start)
+    print('stop entered/predicted', rotation_stop, setup.rotation_stop)
+    print('step entered/predicted', rotation_step, setup.rotation_step)
+    print('num_angles entered/predicted', num_angles, setup.num_angles)
+
+    theta = pso_model.read_theta(control_pvs['ThetaArray'], num_angles)
+    print('theta = ', theta)
+    print('theta check', pso_model.check_theta(theta, setup.rotation_start, setup.rotation_step))
+
 
 
 def main():
@@ -147,6 +152,17 @@ def main():
     print('6')
     set_pso_ok(rotation_start, num_angles, rotation_step)
 
+    rotation_start = 0
+    num_angles = 1234
+    rotation_step = 0.245
+    print('7')
+    set_pso_predicted(rotation_start, num_angles, rotation_step)
+    rotation_start = 0.0
+    num_angles = 1500
+    rotation_step = 0.12
+    print('8')
+    set_pso_predicted(rotation_start, num_angles, rotation_step)
+
 
 if __name__ == "__main__":
     main()
\ No newline at end of file
@@ -1,33 +1,5 @@
-import time
-
-from epics import PV
-
-EPSILON = .001
-
-def wait_pv(epics_pv, wait_val, timeout=-1):
-    """Wait on a pv to be a value until max_timeout (default forever)
-       delay for pv to change
-    """
-
-    time.sleep(.01)
-    start_time = time.time()
-    while True:
-        pv_val = epics_pv.get()
-        if isinstance(pv_val, float):
-            if abs(pv_val - wait_val) < EPSILON:
-                return True
-        if pv_val != wait_val:
-            if timeout > -1:
-                current_time = time.time()
-                diff_time = current_time - start_time
-                if diff_time >= timeout:
-                    log.error('  *** ERROR: DROPPED IMAGES ***')
-                    log.error('  *** wait_pv(%s, %d, %5.2f reached max timeout. Return False',
-                                  epics_pv.pvname, wait_val, timeout)
-                    return False
-            time.sleep(.01)
-        else:
-            return True
+from pv_util import get_pv
+import pso_model
 
 
 def set_pso(rotation_start, num_angles, rotation_step):
@@ -37,18 +9,20 @@ def set_pso(rotation_start, num_angles, rotation_step):
     control_pvs = {}
     prefix = '2bma:PSOFly2:'
 
-    control_pvs['PSOstartPos']        = PV(prefix + 'startPos')
-    control_pvs['PSOendPos']          = PV(prefix + 'endPos')
-    control_pvs['PSOscanDelta']       = PV(prefix + 'scanDelta')
-    control_pvs['PSOcalcProjections'] = PV(prefix + 'numTriggers')        
-    control_pvs['ThetaArray']         = PV(prefix + 'motorPos.AVAL')
-
-    control_pvs['PSOstartPos'].put(rotation_start, wait=True)
-    wait_pv(control_pvs['PSOstartPos'], rotation_start)
-    control_pvs['PSOendPos'].put(rotation_stop, wait=True)
-    wait_pv(control_pvs['PSOendPos'], rotation_stop)
-    control_pvs['PSOscanDelta'].put(rotation_step, wait=True)
-    wait_pv(control_pvs['PSOscanDelta'], rotation_step)
+    control_pvs['PSOstartPos']        = get_pv(prefix + 'startPos')
+    control_pvs['PSOendPos']          = get_pv(prefix + 'endPos')
+    control_pvs['PSOscanDelta']       = get_pv(prefix + 'scanDelta')
+    control_pvs['PSOcalcProjections'] = get_pv(prefix + 'numTriggers')        
+    control_pvs['ThetaArray']         = get_pv(prefix + 'motorPos.AVAL')
+
+    # each pv is written once with put completion, endPos last, and the readbacks,
+    # numTriggers included, are checked once against the values the controller calculates
+    setup = pso_model.predict(rotation_start, rotation_stop, rotation_step)
+    done, status = pso_model.set_pso_pvs(control_pvs, setup)
+    for pv_status in status:
+        print(pv_status.pvname, 'predicted', pv_status.wait_val, 'matches', pv_status.satisfied, 'put in', pv_status.elapsed, 's')
+    if not done:
+        print('readbacks do not match the predicted', setup)
 
     calc_rotation_start = control_pvs['PSOstartPos'].value
     calc_rotation_stop = control_pvs['PSOendPos'].value
@@ -66,6 +40,32 @@ def set_pso(rotation_start, num_angles, rotation_step):
 
     return calc_num_angles, calc_rotation_step
 
+def set_pso_exact(rotation_start, num_angles, rotation_step):
+    """Same as set_pso() with the start, step and stop solved to give exactly num_angles triggers"""
+
+    setup, deviation = pso_model.solve_scan(rotation_start, num_angles, rotation_step)
+    print('solved start/stop/step', setup.rotation_start, setup.rotation_stop, setup.rotation_step,
+          'range deviation', deviation)
+
+    control_pvs = {}
+    prefix = '2bma:PSOFly2:'
+
+    control_pvs['PSOstartPos']        = get_pv(prefix + 'startPos')
+    control_pvs['PSOendPos']          = get_pv(prefix + 'endPos')
+    control_pvs['PSOscanDelta']       = get_pv(prefix + 'scanDelta')
+    control_pvs['PSOcalcProjections'] = get_pv(prefix + 'numTriggers')
+
+    done, status = pso_model.set_pso_pvs(control_pvs, setup)
+    for pv_status in status:
+        print(pv_status.pvname, 'predicted', pv_status.wait_val, 'matches', pv_status.satisfied, 'put in', pv_status.elapsed, 's')
+    if not done:
+        print('readbacks do not match the solved', setup)
+
+    calc_num_angles = control_pvs['PSOcalcProjections'].value
+    print('num_angles entered/calculated', num_angles, calc_num_angles)
+
+    return calc_num_angles, setup.rotation_step
+
 
 def main():
     print('1')
@@ -85,9 +85,9 @@ def main():
     calc_num_angles, calc_rotation_step = set_pso(rotation_start, num_angles, rotation_step)
     print('4')
     rotation_start = 0
-    num_angles = 1235
+    num_angles = 1234
     rotation_step = 0.245
-    calc_num_angles, calc_rotation_step = set_pso(rotation_start, num_angles, rotation_step)
+    calc_num_angles, calc_rotation_step = set_pso_exact(rotation_start, num_angles, rotation_step)
 
 
 if __name__ == "__main__":
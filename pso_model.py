@@ -0,0 +1,307 @@
+'''
+    PSOFly2 encoder quantization model
+
+    The controller works in encoder counts: scanDelta is rounded to a whole number
+    of counts and numTriggers is the number of whole quantized steps that fit between
+    startPos and endPos, e.g. 0.245 deg becomes 8057 counts = 0.24501337 deg and
+    1234 angles from 0 to 302.33 deg give 1233 triggers. Predicting these values
+    lets the set up write each PV once and check all the readbacks in one batch
+    instead of re-writing endPos or sleeping until the controller has recalculated.
+'''
+import time
+import collections
+
+import numpy as np
+
+import log
+from pv_util import EPSILON, WaitStatus, matches
+
+# deg per encoder count of the 2-BM rotary stage
+ENCODER_RESOLUTION = 3.041e-05
+
+PSOSetup = collections.namedtuple('PSOSetup', ['rotation_start', 'rotation_stop', 'rotation_step',
+                                               'num_angles', 'step_counts'])
+ThetaCheck = collections.namedtuple('ThetaCheck', ['valid', 'monotonic', 'first_bad_index', 'max_deviation',
+                                                   'zero_tail'])
+
+# PSOFly2 position PVs in the order they are written, endPos last
+POSITION_KEYS = ('PSOstartPos', 'PSOscanDelta', 'PSOendPos')
+
+def step_counts(rotation_step, resolution=ENCODER_RESOLUTION):
+    """Number of encoder counts the controller uses for a rotation step"""
+
+    return np.round(np.asarray(rotation_step, dtype=float) / resolution).astype(np.int64)
+
+
+def quantize_step(rotation_step, resolution=ENCODER_RESOLUTION):
+    """Rotation step in deg after the controller rounding, i.e. the scanDelta readback"""
+
+    return step_counts(rotation_step, resolution) * resolution
+
+
+def num_triggers(rotation_start, rotation_stop, calc_rotation_step):
+    """Number of triggers the controller calculates for a quantized step
+
+    Works element-wise on arrays, ranges that are empty or have a zero step give 0.
+    """
+
+    start = np.asarray(rotation_start, dtype=float)
+    stop = np.asarray(rotation_stop, dtype=float)
+    step = np.asarray(calc_rotation_step, dtype=float)
+    valid = (step > 0) & (stop > start)
+    n = np.floor((stop - start) / np.where(valid, step, 1) + 1e-9)
+    return np.where(valid, n, 0).astype(np.int64)
+
+
+def predict(rotation_start, rotation_stop, rotation_step, resolution=ENCODER_RESOLUTION):
+    """Predicts the PSOFly2 calculated values for the entered start, stop and step
+
+    Parameters
+    ----------
+    rotation_start, rotation_stop, rotation_step : float or array
+        Values written to startPos, endPos and scanDelta
+
+    resolution : float
+        Encoder resolution in deg per count
+
+    Returns
+    -------
+    PSOSetup
+        startPos and endPos as entered, the scanDelta and numTriggers readbacks
+        and the step in encoder counts. Fields are arrays when the inputs are.
+    """
+
+    counts = step_counts(rotation_step, resolution)
+    calc_rotation_step = counts * resolution
+    calc_num_angles = num_triggers(rotation_start, rotation_stop, calc_rotation_step)
+    if np.ndim(calc_num_angles) == 0:
+        return PSOSetup(float(rotation_start), float(rotation_stop), float(calc_rotation_step),
+                        int(calc_num_angles), int(counts))
+    rotation_start, rotation_stop = np.broadcast_arrays(np.asarray(rotation_start, dtype=float),
+                                                        np.asarray(rotation_stop, dtype=float), calc_num_angles)[:2]
+    return PSOSetup(rotation_start, rotation_stop, calc_rotation_step, calc_num_angles, counts)
+
+
+def predict_scan(rotation_start, num_angles, rotation_step, resolution=ENCODER_RESOLUTION):
+    """Same as predict() for a scan entered as start, number of angles and step
+
+    The stop position is rotation_start + rotation_step * num_angles, as in set_pso().
+    """
+
+    rotation_stop = np.asarray(rotation_start) + np.asarray(rotation_step) * np.asarray(num_angles)
+    return predict(rotation_start, rotation_stop, rotation_step, resolution)
+
+
+def solve(num_angles, rotation_start, rotation_stop, resolution=ENCODER_RESOLUTION, max_step_change=64,
+          max_start_shift=None):
+    """Finds the PSOFly2 set up giving exactly num_angles triggers over a requested range
+
+    Asking for 1234 angles at 0.245 deg from 0 to 302.33 deg gives 1233 triggers
+    because the quantized step (8057 counts) no longer fits 1234 times. All the
+    step counts within max_step_change of the requested step are evaluated at
+    once; for each the start is shifted by a whole number of counts to center
+    the covered range on the requested one and endPos is placed inside the
+    interval where the controller calculates exactly num_angles triggers.
+
+    Parameters
+    ----------
+    num_angles : int
+        Number of triggers wanted
+    rotation_start, rotation_stop : float
+        Requested angular range in deg, covered by num_angles steps
+    resolution : float
+        Encoder resolution in deg per count
+    max_step_change : int
+        Number of encoder counts searched on each side of the requested step
+    max_start_shift : int
+        Maximum start shift in encoder counts, None allows up to half a step,
+        0 keeps the start as entered
+
+    Returns
+    -------
+    setup : PSOSetup
+        Values to write with set_pso_pvs(), rotation_step is the quantized step
+    deviation : float
+        Largest difference in deg between the covered range
+        [rotation_start, rotation_start + num_angles * rotation_step] and the requested one
+
+    Raises
+    ------
+    ValueError
+        If num_angles is not positive or the range is empty
+    """
+
+    num_angles = int(num_angles)
+    if num_angles < 1 or rotation_stop <= rotation_start:
+        raise ValueError('need a positive number of angles over a non empty range, got %d from %s to %s'
+                         % (num_angles, rotation_start, rotation_stop))
+    requested_range = rotation_stop - rotation_start
+    center = int(step_counts(requested_range / num_angles, resolution))
+    counts = np.arange(max(center - max_step_change, 1), center + max_step_change + 1, dtype=np.int64)
+    step = counts * resolution
+
+    # shift the start by a whole number of counts to split the range error between both ends
+    error = num_angles * step - requested_range
+    shift = np.round(-error / 2 / resolution)
+    limit = np.floor(counts / 2) if max_start_shift is None else max_start_shift
+    shift = np.clip(shift, -limit, limit)
+    start = rotation_start + shift * resolution
+    deviation = np.maximum(np.abs(start - rotation_start), np.abs(start + num_angles * step - rotation_stop))
+
+    # endPos closest to the requested stop that still gives exactly num_angles triggers,
+    # one count away from both edges of the interval
+    stop = np.clip(rotation_stop, start + num_angles * step + resolution,
+                   start + (num_angles + 1) * step - resolution)
+    valid = num_triggers(start, stop, step) == num_angles
+    if not np.any(valid):
+        raise ValueError('no step within %d counts gives %d angles from %s to %s'
+                         % (max_step_change, num_angles, rotation_start, rotation_stop))
+
+    # smallest deviation, ties go to the step closest to the requested one
+    order = np.lexsort((np.abs(counts - center), np.where(valid, deviation, np.inf)))
+    best = order[0]
+    setup = PSOSetup(float(start[best]), float(stop[best]), float(step[best]), num_angles, int(counts[best]))
+    return setup, float(deviation[best])
+
+
+def solve_scan(rotation_start, num_angles, rotation_step, resolution=ENCODER_RESOLUTION, **kwargs):
+    """Same as solve() for a scan entered as start, number of angles and step"""
+
+    return solve(num_angles, rotation_start, rotation_start + rotation_step * num_angles, resolution, **kwargs)
+
+
+def theta(setup):
+    """Angles the controller reports in motorPos.AVAL for a predicted set up"""
+
+    return setup.rotation_start + setup.rotation_step * np.arange(setup.num_angles)
+
+
+def setup_values(setup):
+    """Values of a set up by PSOFly2 position PV key"""
+
+    return {'PSOstartPos': setup.rotation_start, 'PSOscanDelta': setup.rotation_step,
+            'PSOendPos': setup.rotation_stop}
+
+
+def set_pso_pvs(control_pvs, setup, timeout=10, keys=POSITION_KEYS):
+    """Writes a predicted set up to PSOFly2 and checks the readbacks once
+
+    Each PV is written once with put completion, in POSITION_KEYS order, so
+    endPos is only processed once startPos and scanDelta are, and the trigger
+    calculation done on the endPos write uses the final step. The readbacks of
+    the three positions and of numTriggers are then read once, without
+    waiting, and compared with the predicted values.
+
+    Parameters
+    ----------
+    control_pvs : dict
+        PVs with the keys PSOstartPos, PSOendPos, PSOscanDelta and PSOcalcProjections
+
+    setup : PSOSetup
+        Values returned by predict() or predict_scan()
+
+    timeout : float
+        Maximum number of seconds to wait for the completion of each put
+
+    keys : sequence of str
+        PVs to write, in POSITION_KEYS order, e.g. the write set of a ScanPlan.
+        All the readbacks are checked whatever is written.
+
+    Returns
+    -------
+    done : bool
+        True if every put completed and every readback matches the prediction
+    status : list of WaitStatus
+        For each readback the pv name, the predicted value, whether it matches
+        and the number of seconds its put took (None if it was not written or
+        did not complete)
+    """
+
+    values = setup_values(setup)
+    start_time = time.time()
+    elapsed = {}
+    completed = True
+    for key in POSITION_KEYS:
+        if key in keys:
+            if control_pvs[key].put(values[key], wait=True, timeout=timeout) == -1:
+                log.error('  *** put %s = %s did not complete within %5.2f s',
+                          control_pvs[key].pvname, values[key], timeout)
+                completed = False
+            else:
+                elapsed[key] = time.time() - start_time
+
+    predicted = [('PSOstartPos', setup.rotation_start, EPSILON),
+                 ('PSOscanDelta', setup.rotation_step, setup.rotation_step * 1e-6),
+                 ('PSOendPos', setup.rotation_stop, EPSILON),
+                 ('PSOcalcProjections', setup.num_angles, 0.5)]
+    status = [WaitStatus(control_pvs[key].pvname, value,
+                         matches(control_pvs[key].get(use_monitor=False), value, tolerance), elapsed.get(key))
+              for key, value, tolerance in predicted]
+    return completed and all(pv_status.satisfied for pv_status in status), status
+
+
+def read_theta(theta_pv, num_angles, out=None):
+    """Reads the first num_angles elements of the ThetaArray waveform
+
+    The waveform is copied once from the channel access array into a new array,
+    or into out so that a caller reading repeatedly can reuse its own buffer.
+
+    Parameters
+    ----------
+    theta_pv : PV
+        motorPos.AVAL waveform
+    num_angles : int
+        Number of elements to read
+    out : ndarray
+        float64 buffer of at least num_angles elements, None for a new array
+
+    Returns
+    -------
+    ndarray
+        num_angles angles, a view of out if given, elements missing from the
+        waveform are 0
+    """
+
+    num_angles = int(num_angles)
+    if out is None:
+        out = np.empty(num_angles)
+    theta = out[:num_angles]
+    value = np.ravel(np.asarray(theta_pv.get(count=num_angles, as_numpy=True), dtype=float))[:num_angles]
+    np.copyto(theta[:len(value)], value)
+    theta[len(value):] = 0
+    return theta
+
+
+def check_theta(theta, rotation_start, rotation_step, tolerance=ENCODER_RESOLUTION):
+    """Validates a ThetaArray against the arithmetic sequence start + i * step
+
+    Parameters
+    ----------
+    theta : ndarray
+        Angles read back from the controller, e.g. by read_theta()
+    rotation_start, rotation_step : float
+        Expected first angle and quantized step, e.g. from predict()
+    tolerance : float
+        Largest deviation in deg accepted for an element
+
+    Returns
+    -------
+    ThetaCheck
+        valid: True if every element is within tolerance; monotonic: True if
+        the angles strictly increase (decrease for a negative step);
+        first_bad_index: first element out of tolerance, -1 if none;
+        max_deviation: largest deviation in deg; zero_tail: number of trailing
+        zeros, e.g. left by a controller that calculated fewer triggers
+    """
+
+    theta = np.asarray(theta, dtype=float)
+    n = len(theta)
+    if n == 0:
+        return ThetaCheck(True, True, -1, 0.0, 0)
+    deviation = np.abs(theta - (rotation_start + rotation_step * np.arange(n)))
+    bad = np.flatnonzero(~(deviation <= tolerance))
+    steps = np.diff(theta) * np.sign(rotation_step)
+    nonzero = np.flatnonzero(theta)
+    zero_tail = n - (nonzero[-1] + 1) if len(nonzero) else n
+    return ThetaCheck(len(bad) == 0, bool(np.all(steps > 0)), int(bad[0]) if len(bad) else -1,
+                      float(deviation.max()), int(zero_tail))
@@ -0,0 +1,89 @@
+'''
+    asyncio wrappers around pyepics PVs
+
+    pyepics runs its callbacks in the Channel Access threads; the wrappers
+    hand the results over to the event loop so independent puts, gets and
+    waits can be gathered concurrently.
+'''
+import asyncio
+import functools
+
+from pv_util import EPSILON, matches
+
+
+def _set_result(future, result):
+    if not future.done():
+        future.set_result(result)
+
+
+class AsyncPV():
+    """Awaitable put, get and wait_for on an existing pyepics PV
+
+    Parameters
+    ----------
+    epics_pv : PV
+        pv to wrap
+    """
+
+    def __init__(self, epics_pv):
+        self.epics_pv = epics_pv
+
+    @property
+    def pvname(self):
+        return self.epics_pv.pvname
+
+    async def put(self, value, timeout=30):
+        """Write value and return when the put completion callback arrives
+
+        Raises
+        ------
+        asyncio.TimeoutError
+            If the put did not complete within timeout seconds
+        """
+
+        loop = asyncio.get_running_loop()
+        completed = loop.create_future()
+
+        def on_complete(**kwargs):
+            loop.call_soon_threadsafe(_set_result, completed, True)
+
+        self.epics_pv.put(value, use_complete=True, callback=on_complete)
+        return await asyncio.wait_for(completed, timeout)
+
+    async def get(self, **kwargs):
+        """Read the pv without blocking the event loop, kwargs are passed to PV.get()"""
+
+        loop = asyncio.get_running_loop()
+        return await loop.run_in_executor(None, functools.partial(self.epics_pv.get, **kwargs))
+
+    async def wait_for(self, wait_val, timeout=None, tolerance=EPSILON):
+        """Return when the monitored pv reaches wait_val
+
+        Raises
+        ------
+        asyncio.TimeoutError
+            If the value was not reached within timeout seconds (None waits forever)
+        """
+
+        loop = asyncio.get_running_loop()
+        reached = loop.create_future()
+
+        def on_change(value=None, **kwargs):
+            if matches(value, wait_val, tolerance):
+                loop.call_soon_threadsafe(_set_result, reached, value)
+
+        index = self.epics_pv.add_callback(on_change)
+        try:
+            # read in the executor, a slow or disconnected pv must not block the event loop
+            value = await self.get()
+            if matches(value, wait_val, tolerance):
+                return value
+            return await asyncio.wait_for(reached, timeout)
+        finally:
+            self.epics_pv.remove_callback(index)
+
+
+def async_pvs(epics_pvs):
+    """Wrap every PV of an epics_pvs dictionary in an AsyncPV"""
+
+    return {key: AsyncPV(epics_pv) for key, epics_pv in epics_pvs.items()}
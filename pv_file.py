@@ -1,15 +1,29 @@
 
 from epics import PV
+import os
+import re
+import csv
+import json
 import time
+import hashlib
+import collections
+import concurrent.futures
 import numpy as np
 
+from pv_util import get_pv, connect_pvs, put_all
+
+CACHE_DIR = os.path.join(os.path.expanduser('~'), '.cache', 'pv_files')
+SNAPSHOT_THREADS = 32
+
+PVSnapshot = collections.namedtuple('PVSnapshot', ['pvname', 'value', 'char_value', 'timestamp', 'severity', 'connected'])
+
 control_pvs = {}
 config_pvs ={}
 pv_prefixes = {}
+_compiled_pv_files = {}
 
-def read_pv_file(pv_file_name, macros):
-    """Reads a file containing a list of EPICS PVs to be used by TomoScan.
-
+def parse_pv_file(pv_file_name, macros):
+    """Parses a file containing a list of EPICS PVs to be used by TomoScan.
 
     Parameters
     ----------
@@ -17,12 +31,22 @@ def read_pv_file(pv_file_name, macros):
       Name of the file to read
     macros: dict
       Dictionary of macro substitution to perform when reading the file
+
+    Returns
+    -------
+    list
+      (dictionary key, PV name, is_config_pv, indirection) for each PV in the file.
+      indirection is 'PVName', 'PVPrefix' or None
     """
 
+    # all macros are substituted in one pass
+    macro_re = re.compile('|'.join(re.escape(key) for key in sorted(macros, key=len, reverse=True)) or '(?!)')
+
     pv_file = open(pv_file_name)
     lines = pv_file.read()
     pv_file.close()
     lines = lines.splitlines()
+    entries = []
     for line in lines:
         is_config_pv = True
         if line.find('#controlPV') != -1:
@@ -35,27 +59,273 @@ def read_pv_file(pv_file_name, macros):
         # Skip blank lines
         if line == '':
             continue
-        pvname = line
         # Do macro substitution on the pvName
-        for key in macros:
-            pvname = pvname.replace(key, macros[key])
+        pvname = macro_re.sub(lambda match: macros[match.group(0)], line)
         # Replace macros in dictionary key with nothing
-        dictentry = line
-        for key in macros:
-            dictentry = dictentry.replace(key, '')
-        epics_pv = PV(pvname)
+        dictentry = macro_re.sub('', line)
+        indirection = None
+        if dictentry.find('PVName') != -1:
+            indirection = 'PVName'
+        elif dictentry.find('PVPrefix') != -1:
+            indirection = 'PVPrefix'
+        entries.append((dictentry, pvname, is_config_pv, indirection))
+    return entries
+
+def compile_pv_file(pv_file_name, macros):
+    """Returns the parsed entries of a PV file, from the cache if the file did not change.
+
+    The entries are cached in memory and in CACHE_DIR, keyed by the file path and the
+    macros, and are parsed again when the file modification time changes.
+
+    Parameters
+    ----------
+    pv_file_name : str
+      Name of the file to read
+    macros: dict
+      Dictionary of macro substitution to perform when reading the file
+
+    Returns
+    -------
+    list
+      The entries returned by parse_pv_file()
+    """
+
+    pv_file_name = os.path.abspath(pv_file_name)
+    mtime = os.stat(pv_file_name).st_mtime_ns
+    key = hashlib.sha1(json.dumps([pv_file_name, sorted(macros.items())]).encode()).hexdigest()
+
+    cached = _compiled_pv_files.get(key)
+    cache_file_name = os.path.join(CACHE_DIR, key + '.json')
+    if cached is None and os.path.exists(cache_file_name):
+        with open(cache_file_name) as cache_file:
+            cached = json.load(cache_file)
+        cached['entries'] = [tuple(entry) for entry in cached['entries']]
+    if cached is None or cached['mtime'] != mtime:
+        cached = {'pv_file_name': pv_file_name, 'mtime': mtime, 'entries': parse_pv_file(pv_file_name, macros)}
+        os.makedirs(CACHE_DIR, exist_ok=True)
+        tmp_file_name = '%s.%d.tmp' % (cache_file_name, os.getpid())
+        with open(tmp_file_name, 'w') as cache_file:
+            json.dump(cached, cache_file)
+        os.replace(tmp_file_name, cache_file_name)
+    _compiled_pv_files[key] = cached
+    return cached['entries']
+
+def read_pv_files(pv_file_names, macros, timeout=5):
+    """Reads files containing lists of EPICS PVs to be used by TomoScan.
+
+    The PVs are loaded in two phases: first the PVs listed in all the files are
+    connected together, then the PVs named by the ``PVName`` PVs are connected
+    together. Files listed more than once are only read once.
+
+    Parameters
+    ----------
+    pv_file_names : list
+      Names of the files to read
+    macros: dict
+      Dictionary of macro substitution to perform when reading the files
+    timeout : float
+      Maximum number of seconds to wait for the connections of each phase
+
+    Returns
+    -------
+    dict
+      Time in seconds taken by the 'parse', 'connect' and 'resolve' phases
+    """
+
+    timing = {}
+    start_time = time.time()
+    pv_file_names = list(dict.fromkeys(os.path.abspath(pv_file_name) for pv_file_name in pv_file_names))
+    entries = []
+    for pv_file_name in pv_file_names:
+        entries += compile_pv_file(pv_file_name, macros)
+    timing['parse'] = time.time() - start_time
+
+    start_time = time.time()
+    connect_pvs([pvname for _, pvname, _, _ in entries], timeout)
+    for dictentry, pvname, is_config_pv, _ in entries:
         if is_config_pv:
-            config_pvs[dictentry] = epics_pv
+            config_pvs[dictentry] = get_pv(pvname)
         else:
-            control_pvs[dictentry] = epics_pv
-        if dictentry.find('PVName') != -1:
-            pvname = epics_pv.value
-            key = dictentry.replace('PVName', '')
-            control_pvs[key] = PV(pvname)
-        if dictentry.find('PVPrefix') != -1:
-            pvprefix = epics_pv.value
-            key = dictentry.replace('PVPrefix', '')
-            pv_prefixes[key] = pvprefix
+            control_pvs[dictentry] = get_pv(pvname)
+    timing['connect'] = time.time() - start_time
+
+    start_time = time.time()
+    indirect_pvs = {}
+    for dictentry, pvname, _, indirection in entries:
+        if indirection == 'PVName':
+            indirect_pvname = get_pv(pvname).value
+            # a disconnected or empty PVName PV names no PV
+            if not indirect_pvname or not isinstance(indirect_pvname, str):
+                print('  *** %s does not name a PV (%r), %s is skipped' % (pvname, indirect_pvname,
+                                                                        dictentry.replace('PVName', '')))
+                continue
+            indirect_pvs[dictentry.replace('PVName', '')] = indirect_pvname
+        elif indirection == 'PVPrefix':
+            pv_prefixes[dictentry.replace('PVPrefix', '')] = get_pv(pvname).value
+    connect_pvs(list(indirect_pvs.values()), timeout)
+    for key, pvname in indirect_pvs.items():
+        control_pvs[key] = get_pv(pvname)
+    timing['resolve'] = time.time() - start_time
+
+    print('read %d PVs (%d indirect) from %d files: parse %.3f s, connect %.3f s, resolve %.3f s' %
+          (len(entries), len(indirect_pvs), len(pv_file_names), timing['parse'], timing['connect'], timing['resolve']))
+    return timing
+
+def read_pv_file(pv_file_name, macros):
+    """Reads a file containing a list of EPICS PVs to be used by TomoScan.
+
+
+    Parameters
+    ----------
+    pv_file_name : str
+      Name of the file to read
+    macros: dict
+      Dictionary of macro substitution to perform when reading the file
+    """
+
+    return read_pv_files([pv_file_name], macros)
+
+def _read_pv(epics_pv, timeout):
+    data = epics_pv.get_with_metadata(form='time', timeout=timeout)
+    if data is None:
+        return PVSnapshot(epics_pv.pvname, None, None, None, None, False)
+    # the string form is read too, the cached char_value can be stale and is empty
+    # for an enum until its ctrl data was fetched
+    string = epics_pv.get_with_metadata(as_string=True, form='ctrl', timeout=timeout)
+    return PVSnapshot(epics_pv.pvname, data['value'], string['value'] if string is not None else None,
+                      data.get('timestamp'), data.get('severity'), True)
+
+def snapshot_pvs(pvs=None, timeout=1.0):
+    """Reads a set of EPICS PVs concurrently.
+
+    Monitored PVs are read from their last monitor update, the others are read
+    in parallel with one timeout per PV.
+
+    Parameters
+    ----------
+    pvs : dict
+      PVs to read, keyed by name. Default is all config_pvs and control_pvs
+    timeout : float
+      Maximum number of seconds to wait for each PV
+
+    Returns
+    -------
+    dict
+      PVSnapshot with value, char_value, timestamp, severity and connection
+      state of each PV, with the same keys as pvs
+    """
+
+    if pvs is None:
+        pvs = dict(config_pvs, **control_pvs)
+    with concurrent.futures.ThreadPoolExecutor(max_workers=SNAPSHOT_THREADS) as executor:
+        futures = {key: executor.submit(_read_pv, epics_pv, timeout) for key, epics_pv in pvs.items()}
+        return {key: future.result() for key, future in futures.items()}
+
+def _json_value(value):
+    if isinstance(value, np.ndarray):
+        return value.tolist()
+    if isinstance(value, np.generic):
+        return value.item()
+    return value
+
+def save_snapshot(snapshot, file_name):
+    """Saves a snapshot as JSON, or as CSV if file_name ends with .csv"""
+
+    if file_name.endswith('.csv'):
+        with open(file_name, 'w', newline='') as snapshot_file:
+            writer = csv.writer(snapshot_file)
+            writer.writerow(('key',) + PVSnapshot._fields)
+            for key, pv_snapshot in snapshot.items():
+                writer.writerow((key,) + pv_snapshot)
+    else:
+        with open(file_name, 'w') as snapshot_file:
+            json.dump({key: {field: _json_value(value) for field, value in pv_snapshot._asdict().items()}
+                       for key, pv_snapshot in snapshot.items()}, snapshot_file, indent=1)
+
+def load_snapshot(file_name):
+    """Loads a snapshot saved as JSON by save_snapshot()"""
+
+    with open(file_name) as snapshot_file:
+        return {key: PVSnapshot(**fields) for key, fields in json.load(snapshot_file).items()}
+
+def diff_snapshots(old, new):
+    """Compares two snapshots.
+
+    Returns
+    -------
+    dict
+      (old PVSnapshot, new PVSnapshot) for each key whose value or connection state
+      changed. The snapshot is None for keys missing in old or new.
+    """
+
+    changes = {}
+    for key in old.keys() | new.keys():
+        old_pv, new_pv = old.get(key), new.get(key)
+        if old_pv is None or new_pv is None or old_pv.connected != new_pv.connected or \
+                not np.array_equal(_json_value(old_pv.value), _json_value(new_pv.value)):
+            changes[key] = (old_pv, new_pv)
+    return changes
+
+def save_configuration(file_name):
+    """Saves a snapshot of all config_pvs as JSON.
+
+    Returns
+    -------
+    dict
+      The snapshot that was saved
+    """
+
+    snapshot = snapshot_pvs(config_pvs)
+    save_snapshot(snapshot, file_name)
+    return snapshot
+
+def restore_configuration(file_name, timeout=30):
+    """Restores config_pvs from a file saved by save_configuration().
+
+    The saved values are compared to the live values and only the PVs that
+    differ are written, all at once, waiting for their put completions. PVs
+    that are disconnected or without write access are not written.
+
+    Parameters
+    ----------
+    file_name : str
+      Name of the configuration file
+    timeout : float
+      Maximum number of seconds to wait for the put completions
+
+    Returns
+    -------
+    changes : dict
+      (live value, restored value) for each PV that was written
+    elapsed : float
+      Time in seconds taken by the restore
+    failed : list
+      Keys of the changed PVs that were not restored: disconnected, without
+      write access, whose put raised or did not complete
+    """
+
+    start_time = time.time()
+    saved = {key: pv_snapshot for key, pv_snapshot in load_snapshot(file_name).items()
+             if key in config_pvs and pv_snapshot.connected}
+    live = snapshot_pvs({key: config_pvs[key] for key in saved})
+    changes = {key: (live_pv.value if live_pv is not None else None, saved_pv.value)
+               for key, (saved_pv, live_pv) in diff_snapshots(saved, live).items()}
+
+    failed = [key for key in changes if not (config_pvs[key].connected and config_pvs[key].write_access)]
+    writes = [key for key in changes if key not in failed]
+    _, status = put_all([(config_pvs[key], changes[key][1]) for key in writes], timeout)
+    failed += [key for key, put_status in zip(writes, status) if not put_status.satisfied]
+    changes = {key: value for key, value in changes.items() if key not in failed}
+    elapsed = time.time() - start_time
+
+    for key, (live_value, value) in changes.items():
+        print(key, ':', live_value, '->', value)
+    for key in failed:
+        print('  *** %s not restored: %s' % (key, 'disconnected' if not config_pvs[key].connected else
+                                              'no write access' if not config_pvs[key].write_access else
+                                              'put failed or did not complete within %.1f s' % timeout))
+    print('restored %d of %d PVs from %s in %.3f s' % (len(changes), len(saved), file_name, elapsed))
+    return changes, elapsed, failed
 
 def show_pvs():
     """Prints the current values of all EPICS PVs in use.
@@ -72,14 +342,17 @@ def show_pvs():
       file plugin, etc.
     """
 
+    config_snapshot = snapshot_pvs(config_pvs)
+    control_snapshot = snapshot_pvs(control_pvs)
+
     print('configPVS:')
     for config_pv in config_pvs:
-        print(config_pv, ':', config_pvs[config_pv].get(as_string=True))
+        print(config_pv, ':', config_snapshot[config_pv].char_value)
 
     print('')
     print('controlPVS:')
     for control_pv in control_pvs:
-        print(control_pv, ':', control_pvs[control_pv].get(as_string=True))
+        print(control_pv, ':', control_snapshot[control_pv].char_value)
 
     print('')
     print('pv_prefixes:')
@@ -118,9 +391,8 @@ def main():
 
     if not isinstance(pv_files, list):
         pv_files = [pv_files]
-    for pv_file in pv_files:
-        read_pv_file(pv_file, macros)
-        show_pvs()
+    read_pv_files(pv_files, macros)
+    show_pvs()
     print(config_pvs['OrthoX'])
     print(config_pvs['OrthoX'].type)
     print(config_pvs['OrthoX'].access)
@@ -0,0 +1,244 @@
+'''
+    Shared helpers for EPICS PVs
+
+'''
+import time
+import threading
+import collections
+
+import epics
+
+import log
+
+EPSILON = .001
+
+WaitStatus = collections.namedtuple('WaitStatus', ['pvname', 'wait_val', 'satisfied', 'elapsed'])
+
+
+_pvs = {}
+_pvs_lock = threading.Lock()
+
+
+def get_pv(pvname):
+    """Return the process wide PV for pvname, creating it on first use
+
+    The PV is shared by all callers, so the connection search and the monitor
+    subscription are only done once per process.
+    """
+
+    with _pvs_lock:
+        epics_pv = _pvs.get(pvname)
+        if epics_pv is None:
+            epics_pv = epics.PV(pvname)
+            _pvs[pvname] = epics_pv
+        return epics_pv
+
+
+def connect_pvs(pvnames, timeout=5):
+    """Connect a set of pvs in parallel
+
+    All the connection searches are started before waiting, and all the pvs share
+    one deadline.
+
+    Parameters
+    ----------
+    pvnames : list of str
+        Names of the pvs to connect
+    timeout : float
+        Maximum number of seconds to wait for all the connections
+
+    Returns
+    -------
+    list of str
+        Names of the pvs that did not connect
+    """
+
+    epics_pvs = [get_pv(pvname) for pvname in pvnames]
+    deadline = time.time() + timeout
+    failed = [epics_pv.pvname for epics_pv in epics_pvs
+              if not epics_pv.wait_for_connection(timeout=max(deadline - time.time(), 0))]
+    for pvname in failed:
+        log.error('  *** %s did not connect within %5.2f s', pvname, timeout)
+    return failed
+
+
+def matches(value, wait_val, tolerance=EPSILON):
+    """True if a pv value equals wait_val, floats are compared within tolerance"""
+
+    if isinstance(value, float):
+        if abs(value - wait_val) < tolerance:
+            return True
+    return value == wait_val
+
+
+def _wait_conditions(conditions, timeout, wait_for_all):
+    conditions = [tuple(condition) + (EPSILON,) * (3 - len(condition)) for condition in conditions]
+    elapsed = [None] * len(conditions)
+    lock = threading.Lock()
+    finished = threading.Event()
+    start_time = time.time()
+
+    def reached(i):
+        with lock:
+            if elapsed[i] is None:
+                elapsed[i] = time.time() - start_time
+            num_reached = len(elapsed) - elapsed.count(None)
+            if num_reached == len(elapsed) or (num_reached > 0 and not wait_for_all):
+                finished.set()
+
+    def make_callback(i, wait_val, tolerance):
+        def on_change(value=None, **kwargs):
+            if matches(value, wait_val, tolerance):
+                reached(i)
+        return on_change
+
+    indices = []
+    try:
+        for i, (epics_pv, wait_val, tolerance) in enumerate(conditions):
+            indices.append(epics_pv.add_callback(make_callback(i, wait_val, tolerance)))
+            if matches(epics_pv.get(), wait_val, tolerance):
+                reached(i)
+        if len(conditions) == 0:
+            finished.set()
+        done = finished.wait(None if timeout < 0 else timeout)
+    finally:
+        for (epics_pv, _, _), index in zip(conditions, indices):
+            epics_pv.remove_callback(index)
+
+    with lock:
+        status = [WaitStatus(epics_pv.pvname, wait_val, t is not None, t)
+                  for (epics_pv, wait_val, _), t in zip(conditions, elapsed)]
+    return done, status
+
+
+def wait_all(conditions, timeout=10):
+    """Wait until all pvs in a set of conditions reach their value
+
+    All the pvs are monitored at the same time under one deadline, so the
+    total wait is that of the slowest pv instead of the sum of all of them.
+    Only wait on readback conditions here: writes that must be processed in
+    order use put(wait=True) first, e.g. pso_model.set_pso_pvs().
+
+    Parameters
+    ----------
+    conditions : list of tuple
+        (epics_pv, wait_val) or (epics_pv, wait_val, tolerance) for each pv
+    timeout : float
+        Maximum number of seconds to wait, -1 to wait forever. A readback
+        quantized by the IOC may never equal the written value, so a finite
+        timeout is the default
+
+    Returns
+    -------
+    done : bool
+        True if all the conditions were satisfied, False on timeout
+    status : list of WaitStatus
+        For each condition the pv name, wait_val, whether it was satisfied and
+        the number of seconds it took (None if it was not)
+    """
+
+    return _wait_conditions(conditions, timeout, True)
+
+
+def wait_any(conditions, timeout=10):
+    """Wait until any pv in a set of conditions reaches its value
+
+    Parameters and return values are the same as wait_all(), done is True as soon as
+    one condition is satisfied.
+    """
+
+    return _wait_conditions(conditions, timeout, False)
+
+
+def put_all(puts, timeout=30):
+    """Write several pvs concurrently and wait for all the put completions
+
+    Only use for pvs that do not depend on each other, the order in which the
+    IOC processes the puts is not guaranteed to be the list order.
+
+    Parameters
+    ----------
+    puts : list of tuple
+        (epics_pv, value) for each pv to write
+    timeout : float
+        Maximum number of seconds to wait for the completions
+
+    Returns
+    -------
+    done : bool
+        True if all the puts completed, False on timeout or if a put failed
+    status : list of WaitStatus
+        For each put the pv name, the value written, whether it completed and
+        the number of seconds it took (None if it did not). A put that raised,
+        e.g. without write access, is logged and did not complete.
+    """
+
+    puts = list(puts)
+    elapsed = [None] * len(puts)
+    pending = [len(puts)]
+    lock = threading.Lock()
+    finished = threading.Event()
+    start_time = time.time()
+
+    def settled():
+        pending[0] -= 1
+        if pending[0] == 0:
+            finished.set()
+
+    def make_callback(i):
+        def on_complete(**kwargs):
+            with lock:
+                elapsed[i] = time.time() - start_time
+                settled()
+        return on_complete
+
+    failed = False
+    for i, (epics_pv, value) in enumerate(puts):
+        try:
+            epics_pv.put(value, use_complete=True, callback=make_callback(i))
+        except Exception as error:
+            log.error('  *** put %s = %s failed: %s', epics_pv.pvname, value, error)
+            failed = True
+            with lock:
+                settled()
+    if len(puts) == 0:
+        finished.set()
+    done = finished.wait(timeout)
+    if not done:
+        log.error('  *** put_all reached max timeout %5.2f s', timeout)
+    done = done and not failed
+
+    with lock:
+        status = [WaitStatus(epics_pv.pvname, value, t is not None, t)
+                  for (epics_pv, value), t in zip(puts, elapsed)]
+    return done, status
+
+
+def wait_pv(epics_pv, wait_val, timeout=-1, tolerance=EPSILON):
+    """Wait on a pv to be a value until max_timeout (default forever)
+
+    The pv is monitored, so this returns as soon as the value update arrives
+    instead of polling the pv.
+
+    Parameters
+    ----------
+    epics_pv : PV
+        pv to wait on
+    wait_val : int, float or str
+        Value to wait for
+    timeout : float
+        Maximum number of seconds to wait, -1 to wait forever
+    tolerance : float
+        Float values within tolerance of wait_val are a match
+
+    Returns
+    -------
+    bool
+        True if the pv reached wait_val, False on timeout
+    """
+
+    done, _ = wait_all([(epics_pv, wait_val, tolerance)], timeout)
+    if not done:
+        log.error('  *** wait_pv(%s, %s, %5.2f) reached max timeout. Return False',
+                  epics_pv.pvname, wait_val, timeout)
+    return done
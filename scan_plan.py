@@ -0,0 +1,211 @@
+'''
+    PSOFly2 scan plan
+
+    Compiles an ordered list of (rotation_start, num_angles, rotation_step) scans
+    into the PSOFly2 values of each scan and the PVs that actually change from one
+    scan to the next, e.g.
+
+        python scan_plan.py 0,1500,0.12 0,1234,0.245 0,1500,0.12 --reorder
+'''
+import sys
+import argparse
+
+import numpy as np
+
+import pso_model
+from pso_model import POSITION_KEYS, ENCODER_RESOLUTION
+
+
+class ScanPlan():
+    """Ordered PSOFly2 scans with their minimal write sets
+
+    A PV is written only when its value differs from the previous scan. The step
+    is compared in encoder counts, so two steps quantized to the same count need
+    no write. Whenever anything is written endPos is written too, last, because
+    the controller recalculates the triggers on the endPos write.
+
+    Parameters
+    ----------
+    scans : list of tuple
+        (rotation_start, num_angles, rotation_step) of each scan
+    initial : PSOSetup
+        Values already in the controller, None to write everything for the first scan
+    exact : bool
+        Use pso_model.solve_scan() so each scan gets exactly num_angles triggers,
+        otherwise pso_model.predict_scan() as set_pso() does
+    write_time : float
+        Expected time in seconds of one PSOFly2 write, e.g. the put p50 of bench.py
+    resolution : float
+        Encoder resolution in deg per count
+    """
+
+    def __init__(self, scans, initial=None, exact=False, write_time=0.01, resolution=ENCODER_RESOLUTION):
+        self.scans = [tuple(scan) for scan in scans]
+        self.initial = initial
+        self.exact = exact
+        self.write_time = write_time
+        self.resolution = resolution
+        if exact:
+            self.setups = [pso_model.solve_scan(*scan, resolution=resolution)[0] for scan in self.scans]
+        else:
+            self.setups = [pso_model.predict_scan(*scan, resolution=resolution) for scan in self.scans]
+        self.writes = [self._changed(previous, setup)
+                       for previous, setup in zip([initial] + self.setups[:-1], self.setups)]
+        self.costs = np.array([len(keys) * write_time for keys in self.writes])
+
+    def __len__(self):
+        return len(self.scans)
+
+    def __iter__(self):
+        return iter(zip(self.setups, self.writes))
+
+    def _changed(self, previous, setup):
+        if previous is None:
+            return list(POSITION_KEYS)
+        tolerance = self.resolution / 2
+        changed = []
+        if abs(setup.rotation_start - previous.rotation_start) > tolerance:
+            changed.append('PSOstartPos')
+        if pso_model.step_counts(setup.rotation_step, self.resolution) != \
+                pso_model.step_counts(previous.rotation_step, self.resolution):
+            changed.append('PSOscanDelta')
+        if changed or abs(setup.rotation_stop - previous.rotation_stop) > tolerance:
+            changed.append('PSOendPos')
+        return changed
+
+    @property
+    def total_cost(self):
+        """Expected reconfiguration time in seconds of the whole plan"""
+
+        return float(self.costs.sum())
+
+    def write_set(self, i):
+        """(key, value) of the PVs to write before scan i, in write order"""
+
+        values = pso_model.setup_values(self.setups[i])
+        return [(key, values[key]) for key in self.writes[i]]
+
+    def transition_costs(self):
+        """Expected reconfiguration time in seconds from scan i (rows) to scan j (columns)"""
+
+        tolerance = self.resolution / 2
+        start = np.array([setup.rotation_start for setup in self.setups])
+        stop = np.array([setup.rotation_stop for setup in self.setups])
+        counts = pso_model.step_counts([setup.rotation_step for setup in self.setups], self.resolution)
+        start_changed = np.abs(start[:, None] - start[None, :]) > tolerance
+        step_changed = counts[:, None] != counts[None, :]
+        stop_changed = start_changed | step_changed | (np.abs(stop[:, None] - stop[None, :]) > tolerance)
+        return (start_changed.astype(int) + step_changed + stop_changed) * self.write_time
+
+    def reorder(self, keep_first=False):
+        """Returns a plan with the same scans ordered to reduce the total reconfiguration time
+
+        The order is built nearest neighbour first (from the initial values, or
+        from the first scan if keep_first) and then improved by reversing
+        sub-sequences (2-opt) while that lowers the cost.
+        """
+
+        n = len(self.scans)
+        if n < 2:
+            return ScanPlan(self.scans, self.initial, self.exact, self.write_time, self.resolution)
+        cost = self.transition_costs()
+        if self.initial is not None and not keep_first:
+            first_cost = np.array([len(self._changed(self.initial, setup)) * self.write_time
+                                   for setup in self.setups])
+        else:
+            first_cost = np.full(n, len(POSITION_KEYS) * self.write_time)
+
+        # nearest neighbour, ties keep the original order
+        order = [0 if keep_first else int(np.argmin(first_cost))]
+        remaining = np.ones(n, dtype=bool)
+        remaining[order[0]] = False
+        while remaining.any():
+            candidates = np.where(remaining, cost[order[-1]], np.inf)
+            order.append(int(np.argmin(candidates)))
+            remaining[order[-1]] = False
+
+        # 2-opt on the open path: reversing order[i:j + 1] replaces the edges into
+        # order[i] and out of order[j], the costs are symmetric so the rest is unchanged
+        order = np.array(order)
+        improved = True
+        while improved:
+            improved = False
+            for i in range(1 if keep_first else 0, n - 1):
+                j = np.arange(i + 1, n)
+                following = order[np.minimum(j + 1, n - 1)]
+                last = j == n - 1
+                if i == 0:
+                    before, new_before = first_cost[order[i]], first_cost[order[j]]
+                else:
+                    before, new_before = cost[order[i - 1], order[i]], cost[order[i - 1], order[j]]
+                after = np.where(last, 0.0, cost[order[j], following])
+                new_after = np.where(last, 0.0, cost[order[i], following])
+                gain = before + after - new_before - new_after
+                best = int(np.argmax(gain))
+                if gain[best] > 1e-12:
+                    order[i:j[best] + 1] = order[i:j[best] + 1][::-1].copy()
+                    improved = True
+        return ScanPlan([self.scans[i] for i in order], self.initial, self.exact, self.write_time,
+                        self.resolution)
+
+    def apply(self, i, control_pvs, timeout=10):
+        """Writes the write set of scan i and checks all the PSOFly2 readbacks
+
+        Returns the (done, status) of pso_model.set_pso_pvs().
+        """
+
+        return pso_model.set_pso_pvs(control_pvs, self.setups[i], timeout, self.writes[i])
+
+
+def show_plan(plan):
+    print('%4s %12s %8s %12s %12s %8s  %s' % ('scan', 'start', 'angles', 'step', 'stop', 'cost s', 'writes'))
+    for i, (setup, keys) in enumerate(plan):
+        print('%4d %12.6f %8d %12.8f %12.6f %8.3f  %s' % (i, setup.rotation_start, setup.num_angles,
+              setup.rotation_step, setup.rotation_stop, plan.costs[i], ' '.join(keys) or '-'))
+    print('total reconfiguration time %.3f s' % plan.total_cost)
+
+
+def _scan(text):
+    try:
+        start, num_angles, step = text.split(',')
+        return float(start), int(num_angles), float(step)
+    except ValueError:
+        raise argparse.ArgumentTypeError('expected start,num_angles,step, got %r' % text)
+
+
+def main(arg):
+
+    parser = argparse.ArgumentParser(description="compile PSOFly2 scans into minimal write sets")
+    parser.add_argument("scans", nargs='+', type=_scan, help="scans as start,num_angles,step")
+    parser.add_argument("--exact", action="store_true", help="solve each scan for exactly num_angles triggers")
+    parser.add_argument("--reorder", action="store_true", help="reorder the scans to reduce the reconfiguration time")
+    parser.add_argument("--keep_first", action="store_true", help="keep the first scan first when reordering")
+    parser.add_argument("--write_time", type=float, default=0.01, help="time of one PSOFly2 write in s: 0.01 (default 0.01)")
+    parser.add_argument("--apply", action="store_true", help="write the plan scan after scan to PSOFly2")
+
+    args = parser.parse_args(arg)
+
+    plan = ScanPlan(args.scans, exact=args.exact, write_time=args.write_time)
+    show_plan(plan)
+    if args.reorder:
+        plan = plan.reorder(args.keep_first)
+        print('reordered')
+        show_plan(plan)
+
+    if args.apply:
+        from pv_util import get_pv
+
+        prefix = '2bma:PSOFly2:'
+        control_pvs = {}
+        control_pvs['PSOstartPos']        = get_pv(prefix + 'startPos')
+        control_pvs['PSOendPos']          = get_pv(prefix + 'endPos')
+        control_pvs['PSOscanDelta']       = get_pv(prefix + 'scanDelta')
+        control_pvs['PSOcalcProjections'] = get_pv(prefix + 'numTriggers')
+        for i in range(len(plan)):
+            done, status = plan.apply(i, control_pvs)
+            print(i, 'wrote', ' '.join(plan.writes[i]) or '-', 'readbacks ok' if done else 'readbacks DO NOT MATCH',
+                  'in %.4f s' % max([pv_status.elapsed or 0 for pv_status in status]))
+
+
+if __name__ == "__main__":
+    main(sys.argv[1:])
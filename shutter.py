@@ -1,52 +1,28 @@
 import os
 import sys
-import time
 import argparse
-from epics import PV
 from datetime import datetime
 
 import log
-
-def wait_pv(epics_pv, wait_val, timeout=-1):
-    """Wait on a pv to be a value until max_timeout (default forever)
-       delay for pv to change
-    """
-
-    time.sleep(.01)
-    start_time = time.time()
-    while True:
-        pv_val = epics_pv.get()
-        if isinstance(pv_val, float):
-            if abs(pv_val - wait_val) < EPSILON:
-                return True
-        if pv_val != wait_val:
-            if timeout > -1:
-                current_time = time.time()
-                diff_time = current_time - start_time
-                if diff_time >= timeout:
-                    log.error('  *** ERROR: DROPPED IMAGES ***')
-                    log.error('  *** wait_pv(%s, %d, %5.2f reached max timeout. Return False',
-                                  epics_pv.pvname, wait_val, timeout)
-                    return False
-            time.sleep(.01)
-        else:
-            return True
+from pv_util import wait_pv, get_pv, connect_pvs
 
 def set_pvs():
     epics_pvs = {}
-    epics_pvs['Energy'] = PV('2bma:TomoScan:Energy.VAL')
-    epics_pvs['Energy_Mode'] = PV('2bma:TomoScan:EnergyMode.VAL')
+    epics_pvs['Energy'] = get_pv('2bma:TomoScan:Energy.VAL')
+    epics_pvs['Energy_Mode'] = get_pv('2bma:TomoScan:EnergyMode.VAL')
 
-    epics_pvs['CloseShutterPVName']   = PV('2bma:TomoScan:CloseShutterPVName')
-    epics_pvs['CloseShutterValue']    = PV('2bma:TomoScan:CloseShutterValue')
-    epics_pvs['OpenShutterPVName']    = PV('2bma:TomoScan:OpenShutterPVName')
-    epics_pvs['OpenShutterValue']     = PV('2bma:TomoScan:OpenShutterValue')
-    # epics_pvs['ShutterStatusPVName']  = PV('2bma:TomoScan:ShutterStatusPVName')
+    epics_pvs['CloseShutterPVName']   = get_pv('2bma:TomoScan:CloseShutterPVName')
+    epics_pvs['CloseShutterValue']    = get_pv('2bma:TomoScan:CloseShutterValue')
+    epics_pvs['OpenShutterPVName']    = get_pv('2bma:TomoScan:OpenShutterPVName')
+    epics_pvs['OpenShutterValue']     = get_pv('2bma:TomoScan:OpenShutterValue')
+    # epics_pvs['ShutterStatusPVName']  = get_pv('2bma:TomoScan:ShutterStatusPVName')
+    connect_pvs([epics_pv.pvname for epics_pv in epics_pvs.values()])
 
-    epics_pvs['CloseShutter']        = PV(epics_pvs['CloseShutterPVName'].get(as_string=True))
-    epics_pvs['OpenShutter']         = PV(epics_pvs['OpenShutterPVName'].get(as_string=True))
-    epics_pvs['ShutterStatus']       = PV('PA:02BM:STA_A_FES_OPEN_PL')
+    epics_pvs['CloseShutter']        = get_pv(epics_pvs['CloseShutterPVName'].get(as_string=True))
+    epics_pvs['OpenShutter']         = get_pv(epics_pvs['OpenShutterPVName'].get(as_string=True))
+    epics_pvs['ShutterStatus']       = get_pv('PA:02BM:STA_A_FES_OPEN_PL')
 
+    connect_pvs([epics_pvs[key].pvname for key in ('CloseShutter', 'OpenShutter', 'ShutterStatus')])
     return epics_pvs
 
 
@@ -0,0 +1,551 @@
+'''
+    In-process simulated IOC
+
+    Serves the 2bma:PSOFly2:, 2bmbSP1:cam1:, 2bma:TomoScan: and shutter PVs
+    used by these scripts so they can run and be profiled without the
+    beamline. install() replaces epics.PV with SimPV, and
+
+        python sim_ioc.py trigger_mode.py
+
+    runs a script unchanged against the simulation.
+'''
+import sys
+import time
+import heapq
+import runpy
+import argparse
+import threading
+import itertools
+import numpy as np
+
+import epics
+
+import pso_model
+
+PSO_PREFIX = '2bma:PSOFly2:'
+CAMERA_PREFIX = '2bmbSP1:cam1:'
+TOMOSCAN_PREFIX = '2bma:TomoScan:'
+OPEN_SHUTTER_PV = '2bma:A_shutter:open.VAL'
+CLOSE_SHUTTER_PV = '2bma:A_shutter:close.VAL'
+SHUTTER_STATUS_PV = 'PA:02BM:STA_A_FES_OPEN_PL'
+
+# camera readout time in s per model and pixel format
+READOUT_TIMES = {
+    'Oryx ORX-10G-51S5M': {'Mono8': 6.18e-3, 'Mono12Packed': 8.20e-3, 'Mono16': 12.34e-3},
+    'Grasshopper3 GS3-U3-23S6M': {'Mono8': 6.2e-3, 'Mono12Packed': 9.2e-3, 'Mono16': 12.2e-3},
+}
+THETA_NELM = 100000
+
+
+class Record():
+    """A simulated PV record
+
+    Parameters
+    ----------
+    ioc : SimIOC
+        The IOC serving the record
+    name : str
+        PV name
+    value : int, float, str or ndarray
+        Initial value
+    enum_strs : list of str
+        Enum choices, value is the index of the choice
+    handler : callable
+        handler(record, value, complete) processes a put, it must call complete()
+        when the put is done. Default sets the value and completes
+    """
+
+    def __init__(self, ioc, name, value=0.0, enum_strs=None, handler=None):
+        self.ioc = ioc
+        self.name = name
+        self.value = value
+        self.enum_strs = enum_strs
+        self.handler = handler
+        self.timestamp = time.time()
+        self.severity = 0
+        self.callbacks = {}
+
+    @property
+    def char_value(self):
+        if self.enum_strs is not None:
+            return self.enum_strs[self.value] if 0 <= self.value < len(self.enum_strs) else str(self.value)
+        if isinstance(self.value, np.ndarray):
+            return '<array size=%d, type=%s>' % (len(self.value), self.value.dtype)
+        return str(self.value)
+
+    def convert(self, value):
+        """Converts a put value to the record type, strings select enum choices"""
+
+        if self.enum_strs is not None:
+            if isinstance(value, str):
+                if value in self.enum_strs:
+                    return self.enum_strs.index(value)
+                return int(value)
+            return int(value)
+        if isinstance(self.value, str):
+            return str(value)
+        if isinstance(self.value, np.ndarray):
+            return np.asarray(value, dtype=self.value.dtype)
+        if isinstance(self.value, (int, np.integer)) and not isinstance(self.value, bool):
+            return int(float(value))
+        return float(value)
+
+    def set(self, value):
+        """Sets the value and posts a monitor update"""
+
+        self.value = value
+        self.timestamp = time.time()
+        for callback, kwargs in list(self.callbacks.values()):
+            callback(pvname=self.name, value=self.value, char_value=self.char_value,
+                     timestamp=self.timestamp, severity=self.severity, status=0, **kwargs)
+
+
+class SimIOC():
+    """Simulated PSOFly2, camera, shutter and energy IOCs
+
+    Parameters
+    ----------
+    latency : float
+        Default time in seconds for a put to be processed
+    latencies : dict
+        Put latency by PV name or PV name prefix, the longest match is used
+    slew_speed : float
+        Default rotation speed in deg/s during a fly scan
+    taxi_time : float
+        Time in seconds of the PSO taxi move
+    shutter_time : float
+        Time in seconds for the shutter status to follow an open or close
+    energy_time : float
+        Time in seconds to complete an energy change
+    camera_model : str
+        Model reported by the camera, a key of READOUT_TIMES
+    """
+
+    def __init__(self, latency=0.001, latencies=None, slew_speed=5.0, taxi_time=0.5, shutter_time=1.0,
+                 energy_time=2.0, camera_model='Oryx ORX-10G-51S5M'):
+        self.latency = latency
+        self.latencies = dict(latencies or {})
+        self.taxi_time = taxi_time
+        self.shutter_time = shutter_time
+        self.energy_time = energy_time
+        self.records = {}
+        self.lock = threading.RLock()
+        self.queue = []
+        self.queue_cv = threading.Condition()
+        self.sequence = itertools.count()
+        self.acquisition = itertools.count()
+        self.camera_acquisition = None
+        self.camera_busy_until = 0
+        self.thread = threading.Thread(target=self._run, name='SimIOC', daemon=True)
+        self.thread.start()
+
+        self._add_pso_records(slew_speed)
+        self._add_camera_records(camera_model)
+        self._add_tomoscan_records()
+
+    # scheduler
+
+    def schedule(self, delay, function, *args):
+        """Runs function(*args) in the IOC thread after delay seconds"""
+
+        with self.queue_cv:
+            heapq.heappush(self.queue, (time.time() + delay, next(self.sequence), function, args))
+            self.queue_cv.notify()
+
+    def _run(self):
+        while True:
+            with self.queue_cv:
+                while not self.queue or self.queue[0][0] > time.time():
+                    self.queue_cv.wait(None if not self.queue else self.queue[0][0] - time.time())
+                _, _, function, args = heapq.heappop(self.queue)
+            with self.lock:
+                function(*args)
+
+    # records
+
+    def add_record(self, name, value=0.0, enum_strs=None, handler=None):
+        record = Record(self, name, value, enum_strs, handler)
+        self.records[name] = record
+        return record
+
+    def record(self, name):
+        """Returns the record for a PV name, unknown names are served as soft records"""
+
+        with self.lock:
+            if name not in self.records:
+                self.add_record(name)
+            return self.records[name]
+
+    def put_latency(self, name):
+        matches = [prefix for prefix in self.latencies if name.startswith(prefix)]
+        if matches:
+            return self.latencies[max(matches, key=len)]
+        return self.latency
+
+    def put(self, name, value, complete):
+        """Processes a put after the latency of the PV, complete() is called when it is done"""
+
+        record = self.record(name)
+        value = record.convert(value)
+        self.schedule(self.put_latency(name), self._process, record, value, complete)
+
+    def _process(self, record, value, complete):
+        if record.handler is None:
+            record.set(value)
+            complete()
+        else:
+            record.handler(record, value, complete)
+
+    def value(self, name):
+        return self.records[name].value
+
+    # PSOFly2
+
+    def _add_pso_records(self, slew_speed):
+        p = PSO_PREFIX
+        self.add_record(p + 'startPos', 0.0, handler=self._pso_position)
+        self.add_record(p + 'endPos', 0.0, handler=self._pso_position)
+        self.add_record(p + 'scanDelta', 0.0, handler=self._pso_position)
+        self.add_record(p + 'slewSpeed', slew_speed)
+        self.add_record(p + 'numTriggers', 0)
+        self.add_record(p + 'motorPos.AVAL', np.zeros(THETA_NELM))
+        self.add_record(p + 'taxi', 0, ['Done', 'Taxi'], handler=self._pso_taxi)
+        self.add_record(p + 'fly', 0, ['Done', 'Fly'], handler=self._pso_fly)
+        self.add_record(p + 'scanControl', 0, ['Standard', 'Custom'])
+
+    def _pso_position(self, record, value, complete):
+        p = PSO_PREFIX
+        if record.name == p + 'scanDelta':
+            # the controller works in encoder counts
+            value = float(pso_model.quantize_step(value))
+        # the derived values are posted before the written record
+        record.value = value
+        start, end, delta = self.value(p + 'startPos'), self.value(p + 'endPos'), self.value(p + 'scanDelta')
+        num_triggers = min(int(pso_model.num_triggers(start, end, delta)), THETA_NELM)
+        theta = np.zeros(THETA_NELM)
+        theta[:num_triggers] = start + delta * np.arange(num_triggers)
+        self.records[p + 'numTriggers'].set(num_triggers)
+        self.records[p + 'motorPos.AVAL'].set(theta)
+        record.set(value)
+        complete()
+
+    def _pso_taxi(self, record, value, complete):
+        if value == 0:
+            record.set(0)
+            complete()
+            return
+        record.set(1)
+
+        def done():
+            record.set(0)
+            complete()
+        self.schedule(self.taxi_time, done)
+
+    def _pso_fly(self, record, value, complete):
+        p = PSO_PREFIX
+        if value == 0:
+            record.set(0)
+            complete()
+            return
+        record.set(1)
+        num_triggers = self.value(p + 'numTriggers')
+        period = self.value(p + 'scanDelta') / self.value(p + 'slewSpeed')
+        for i in range(num_triggers):
+            self.schedule(i * period, self._camera_trigger)
+
+        def done():
+            record.set(0)
+            complete()
+        self.schedule(num_triggers * period, done)
+
+    # camera
+
+    def _add_camera_records(self, camera_model):
+        p = CAMERA_PREFIX
+        self.add_record(p + 'Manufacturer_RBV', 'FLIR')
+        self.add_record(p + 'Model_RBV', camera_model)
+        self.add_record(p + 'PortName_RBV', 'SP1')
+        self.add_record(p + 'Acquire', 0, ['Done', 'Acquire'], handler=self._camera_acquire)
+        self.add_record(p + 'AcquireBusy', 0, ['Done', 'Acquiring'])
+        self.add_record(p + 'ImageMode', 2, ['Single', 'Multiple', 'Continuous'])
+        self.add_record(p + 'TriggerMode', 0, ['Off', 'On'])
+        self.add_record(p + 'NumImages', 1)
+        self.add_record(p + 'NumImagesCounter_RBV', 0)
+        self.add_record(p + 'AcquireTime', 0.001, handler=self._camera_acquire_time)
+        self.add_record(p + 'AcquireTime_RBV', 0.001)
+        self.add_record(p + 'BinX', 1)
+        self.add_record(p + 'BinY', 1)
+        self.add_record(p + 'WaitForPlugins', 0, ['No', 'Yes'])
+        self.add_record(p + 'PixelFormat', 0, ['Mono8', 'Mono12Packed', 'Mono16'])
+        self.add_record(p + 'VideoMode', 0, ['Mode0', 'Mode1', 'Mode5', 'Mode7'])
+        self.add_record(p + 'ArrayCallbacks', 1, ['Disable', 'Enable'])
+        self.add_record(p + 'FrameRateEnable', 0, ['No', 'Yes'])
+        # these can only be changed with TriggerMode Off
+        self.add_record(p + 'ExposureMode', 0, ['Timed', 'TriggerWidth'], handler=self._camera_trigger_setting)
+        self.add_record(p + 'TriggerOverlap', 0, ['Off', 'ReadOut'], handler=self._camera_trigger_setting)
+        self.add_record(p + 'TriggerSource', 0, ['Software', 'Line0', 'Line2', 'Line3'],
+                        handler=self._camera_trigger_setting)
+
+    def camera_frame_time(self):
+        """Minimum time in seconds between two frames of the camera"""
+
+        p = CAMERA_PREFIX
+        pixel_format = self.records[p + 'PixelFormat'].char_value
+        readout = READOUT_TIMES.get(self.value(p + 'Model_RBV'), {}).get(pixel_format, 0.01)
+        return max(self.value(p + 'AcquireTime_RBV'), readout)
+
+    def _camera_acquire_time(self, record, value, complete):
+        record.set(value)
+        self.records[CAMERA_PREFIX + 'AcquireTime_RBV'].set(value)
+        complete()
+
+    def _camera_trigger_setting(self, record, value, complete):
+        if self.value(CAMERA_PREFIX + 'TriggerMode') == 1:
+            # the camera rejects the change, the record posts its old value back
+            record.severity = 2
+            record.set(record.value)
+            record.severity = 0
+        else:
+            record.set(value)
+        complete()
+
+    def _camera_acquire(self, record, value, complete):
+        p = CAMERA_PREFIX
+        if value == 0:
+            self._camera_stop()
+            complete()
+            return
+        if self.camera_acquisition is not None:
+            complete()
+            return
+        acquisition = next(self.acquisition)
+        self.camera_acquisition = (acquisition, complete)
+        self.camera_busy_until = 0
+        self.records[p + 'NumImagesCounter_RBV'].set(0)
+        record.set(1)
+        self.records[p + 'AcquireBusy'].set(1)
+        if self.value(p + 'TriggerMode') == 0:
+            self.schedule(self.camera_frame_time(), self._camera_free_run, acquisition)
+
+    def _camera_stop(self):
+        p = CAMERA_PREFIX
+        if self.camera_acquisition is not None:
+            _, complete = self.camera_acquisition
+            self.camera_acquisition = None
+            complete()
+        self.records[p + 'Acquire'].set(0)
+        self.records[p + 'AcquireBusy'].set(0)
+
+    def _camera_frame(self):
+        p = CAMERA_PREFIX
+        counter = self.value(p + 'NumImagesCounter_RBV') + 1
+        self.records[p + 'NumImagesCounter_RBV'].set(counter)
+        image_mode = self.records[p + 'ImageMode'].char_value
+        if (image_mode == 'Single' and counter >= 1) or (image_mode == 'Multiple' and counter >= self.value(p + 'NumImages')):
+            self._camera_stop()
+
+    def _camera_free_run(self, acquisition):
+        if self.camera_acquisition is None or self.camera_acquisition[0] != acquisition:
+            return
+        self._camera_frame()
+        if self.camera_acquisition is not None:
+            self.schedule(self.camera_frame_time(), self._camera_free_run, acquisition)
+
+    def _camera_trigger(self):
+        p = CAMERA_PREFIX
+        if self.camera_acquisition is None or self.value(p + 'TriggerMode') != 1 or \
+                self.records[p + 'TriggerSource'].char_value != 'Line2':
+            return
+        now = time.time()
+        # triggers arriving while the camera is still busy with the previous frame are dropped
+        if now < self.camera_busy_until:
+            return
+        self.camera_busy_until = now + self.camera_frame_time()
+        self.schedule(self.camera_frame_time(), self._camera_frame)
+
+    # TomoScan energy and shutter
+
+    def _add_tomoscan_records(self):
+        p = TOMOSCAN_PREFIX
+        self.add_record(p + 'Energy.VAL', 24.9, handler=self._energy)
+        self.add_record(p + 'EnergyMode.VAL', 0, ['Mono', 'Pink'], handler=self._energy)
+        self.add_record(p + 'CloseShutterPVName', CLOSE_SHUTTER_PV)
+        self.add_record(p + 'CloseShutterValue', '1')
+        self.add_record(p + 'OpenShutterPVName', OPEN_SHUTTER_PV)
+        self.add_record(p + 'OpenShutterValue', '1')
+        self.add_record(OPEN_SHUTTER_PV, 0, ['Off', 'On'], handler=self._shutter)
+        self.add_record(CLOSE_SHUTTER_PV, 0, ['Off', 'On'], handler=self._shutter)
+        self.add_record(SHUTTER_STATUS_PV, 0, ['OFF', 'ON'])
+
+    def _energy(self, record, value, complete):
+        record.set(value)
+        self.schedule(self.energy_time, complete)
+
+    def _shutter(self, record, value, complete):
+        record.set(value)
+        status = 1 if record.name == OPEN_SHUTTER_PV else 0
+        self.schedule(self.shutter_time, self.records[SHUTTER_STATUS_PV].set, status)
+        complete()
+
+
+_ioc = None
+
+
+def get_ioc():
+    """Returns the simulated IOC used by SimPV, creating it with the defaults on first use"""
+
+    global _ioc
+    if _ioc is None:
+        _ioc = SimIOC()
+    return _ioc
+
+
+class SimPV():
+    """Drop-in replacement for the parts of epics.PV used by these scripts"""
+
+    def __init__(self, pvname, callback=None, form='time', auto_monitor=None, **kwargs):
+        self.pvname = pvname
+        self.form = form
+        self.auto_monitor = True
+        self.connected = True
+        self.read_access = True
+        self.write_access = True
+        self.put_complete = True
+        self.record = get_ioc().record(pvname)
+        self.callback_index = itertools.count(1)
+        self.callback_indices = []
+        if callback is not None:
+            self.add_callback(callback)
+
+    def wait_for_connection(self, timeout=None):
+        return True
+
+    @property
+    def value(self):
+        return self.get()
+
+    @property
+    def char_value(self):
+        return self.record.char_value
+
+    @property
+    def enum_strs(self):
+        return self.record.enum_strs
+
+    @property
+    def timestamp(self):
+        return self.record.timestamp
+
+    @property
+    def severity(self):
+        return self.record.severity
+
+    @property
+    def count(self):
+        return len(self.record.value) if isinstance(self.record.value, np.ndarray) else 1
+
+    @property
+    def type(self):
+        if self.record.enum_strs is not None:
+            return 'time_enum'
+        return 'time_' + {str: 'string', int: 'long'}.get(type(self.record.value), 'double')
+
+    def get(self, count=None, as_string=False, as_numpy=True, timeout=None, use_monitor=True, **kwargs):
+        if as_string:
+            return self.record.char_value
+        value = self.record.value
+        if isinstance(value, np.ndarray):
+            value = value[:count].copy() if count is not None else value.copy()
+            return value if as_numpy else value.tolist()
+        return value
+
+    def get_with_metadata(self, count=None, as_string=False, timeout=None, form=None, use_monitor=True, **kwargs):
+        return {'value': self.get(count=count, as_string=as_string), 'timestamp': self.record.timestamp,
+                'severity': self.record.severity, 'status': 0}
+
+    def put(self, value, wait=False, timeout=30.0, use_complete=False, callback=None, callback_data=None):
+        completed = threading.Event()
+        self.put_complete = False
+
+        def complete():
+            self.put_complete = True
+            completed.set()
+            if callback is not None:
+                callback(pvname=self.pvname, data=callback_data)
+
+        get_ioc().put(self.pvname, value, complete)
+        if wait:
+            completed.wait(timeout)
+            return 1 if completed.is_set() else -1
+        return 1
+
+    def add_callback(self, callback=None, index=None, run_now=False, with_ctrlvars=True, **kwargs):
+        if index is None:
+            index = next(self.callback_index)
+        with self.record.ioc.lock:
+            self.record.callbacks[(id(self), index)] = (callback, dict(kwargs, cb_info=(index, self)))
+        self.callback_indices.append(index)
+        if run_now:
+            callback(pvname=self.pvname, value=self.record.value, char_value=self.record.char_value,
+                     timestamp=self.record.timestamp, severity=self.record.severity, status=0, **kwargs)
+        return index
+
+    def remove_callback(self, index=None):
+        with self.record.ioc.lock:
+            self.record.callbacks.pop((id(self), index), None)
+
+    def clear_callbacks(self):
+        for index in self.callback_indices:
+            self.remove_callback(index)
+        self.callback_indices = []
+
+    def __repr__(self):
+        return "<SimPV '%s', value=%s>" % (self.pvname, self.record.char_value)
+
+
+def install(ioc=None):
+    """Makes epics.PV, caget and caput use the simulated IOC
+
+    Must be called before the scripts do ``from epics import PV``.
+    """
+
+    global _ioc
+    if ioc is not None:
+        _ioc = ioc
+    get_ioc()
+    epics.PV = SimPV
+    epics.pv.PV = SimPV
+    epics.caget = lambda pvname, as_string=False, **kwargs: SimPV(pvname).get(as_string=as_string)
+    epics.caput = lambda pvname, value, wait=False, timeout=60, **kwargs: SimPV(pvname).put(value, wait, timeout)
+    return _ioc
+
+
+def main(arg):
+
+    parser = argparse.ArgumentParser(description="run a script against the simulated IOC")
+    parser.add_argument("--latency", type=float, default=0.001, help="put latency in s: 0.001 (default 0.001)")
+    parser.add_argument("--pso_latency", type=float, default=None, help="put latency in s of the PSOFly2 PVs (default --latency)")
+    parser.add_argument("--camera_latency", type=float, default=None, help="put latency in s of the camera PVs (default --latency)")
+    parser.add_argument("--slew_speed", type=float, default=5.0, help="fly scan speed in deg/s: 5 (default 5)")
+    parser.add_argument("--taxi_time", type=float, default=0.5, help="taxi time in s: 0.5 (default 0.5)")
+    parser.add_argument("--shutter_time", type=float, default=1.0, help="shutter status latency in s: 1 (default 1)")
+    parser.add_argument("--camera_model", default='Oryx ORX-10G-51S5M', choices=list(READOUT_TIMES), help="camera model")
+    parser.add_argument("script", help="script to run, e.g. trigger_mode.py")
+    parser.add_argument("script_args", nargs=argparse.REMAINDER, help="arguments passed to the script")
+
+    args = parser.parse_args(arg)
+
+    latencies = {}
+    if args.pso_latency is not None:
+        latencies[PSO_PREFIX] = args.pso_latency
+    if args.camera_latency is not None:
+        latencies[CAMERA_PREFIX] = args.camera_latency
+    install(SimIOC(args.latency, latencies, args.slew_speed, args.taxi_time, args.shutter_time,
+                   camera_model=args.camera_model))
+
+    sys.argv = [args.script] + args.script_args
+    runpy.run_path(args.script, run_name='__main__')
+
+
+if __name__ == "__main__":
+    main(sys.argv[1:])
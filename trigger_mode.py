@@ -1,76 +1,68 @@
 import os
 import sys
 import time
+import asyncio
+import threading
+import itertools
+import collections
+import concurrent.futures
 import argparse
-from epics import PV
 from datetime import datetime
 
-EPSILON=0.01
-
 import log
+from pv_util import wait_pv, put_all, matches, get_pv, connect_pvs
+from pv_async import async_pvs
+import pso_model
+from drop_detector import DropDetector
+from camera_readout import CameraIdentity, get_registry
 
-def wait_pv(epics_pv, wait_val, timeout=-1):
-    """Wait on a pv to be a value until max_timeout (default forever)
-       delay for pv to change
-    """
+EPSILON = .01
 
-    time.sleep(.01)
-    start_time = time.time()
-    while True:
-        pv_val = epics_pv.get()
-        if isinstance(pv_val, float):
-            if abs(pv_val - wait_val) < EPSILON:
-                return True
-        if pv_val != wait_val:
-            if timeout > -1:
-                current_time = time.time()
-                diff_time = current_time - start_time
-                if diff_time >= timeout:
-                    log.error('  *** ERROR: DROPPED IMAGES ***')
-                    log.error('  *** wait_pv(%s, %d, %5.2f reached max timeout. Return False',
-                          epics_pv.pvname, wait_val, timeout)
-                    return False
-            time.sleep(.01)
-        else:
-            return True
+_camera_identities = {}
 
 def set_pvs():
     epics_pvs = {}
 
     camera_prefix = '2bmbSP1:cam1:'
-    epics_pvs['CamManufacturer']      = PV(camera_prefix + 'Manufacturer_RBV')
-    epics_pvs['CamModel']             = PV(camera_prefix + 'Model_RBV')
-    epics_pvs['CamAcquire']           = PV(camera_prefix + 'Acquire')
-    epics_pvs['CamAcquireBusy']       = PV(camera_prefix + 'AcquireBusy')
-    epics_pvs['CamImageMode']         = PV(camera_prefix + 'ImageMode')
-    epics_pvs['CamTriggerMode']       = PV(camera_prefix + 'TriggerMode')
-    epics_pvs['CamNumImages']         = PV(camera_prefix + 'NumImages')
-    epics_pvs['CamNumImagesCounter']  = PV(camera_prefix + 'NumImagesCounter_RBV')
-    epics_pvs['CamAcquireTime']       = PV(camera_prefix + 'AcquireTime')
-    epics_pvs['CamAcquireTimeRBV']    = PV(camera_prefix + 'AcquireTime_RBV')
-    epics_pvs['CamBinX']              = PV(camera_prefix + 'BinX')
-    epics_pvs['CamBinY']              = PV(camera_prefix + 'BinY')
-    epics_pvs['CamWaitForPlugins']    = PV(camera_prefix + 'WaitForPlugins')
-    epics_pvs['PortNameRBV']          = PV(camera_prefix + 'PortName_RBV')
-
-    epics_pvs['CamExposureMode']     = PV(camera_prefix + 'ExposureMode')
-    epics_pvs['CamTriggerOverlap']   = PV(camera_prefix + 'TriggerOverlap')
-    epics_pvs['CamPixelFormat']      = PV(camera_prefix + 'PixelFormat')
-    epics_pvs['CamArrayCallbacks']   = PV(camera_prefix + 'ArrayCallbacks')
-    epics_pvs['CamFrameRateEnable']  = PV(camera_prefix + 'FrameRateEnable')
-    epics_pvs['CamTriggerSource']    = PV(camera_prefix + 'TriggerSource')
+    epics_pvs['CamManufacturer']      = get_pv(camera_prefix + 'Manufacturer_RBV')
+    epics_pvs['CamModel']             = get_pv(camera_prefix + 'Model_RBV')
+    epics_pvs['CamAcquire']           = get_pv(camera_prefix + 'Acquire')
+    epics_pvs['CamAcquireBusy']       = get_pv(camera_prefix + 'AcquireBusy')
+    epics_pvs['CamImageMode']         = get_pv(camera_prefix + 'ImageMode')
+    epics_pvs['CamTriggerMode']       = get_pv(camera_prefix + 'TriggerMode')
+    epics_pvs['CamNumImages']         = get_pv(camera_prefix + 'NumImages')
+    epics_pvs['CamNumImagesCounter']  = get_pv(camera_prefix + 'NumImagesCounter_RBV')
+    epics_pvs['CamAcquireTime']       = get_pv(camera_prefix + 'AcquireTime')
+    epics_pvs['CamAcquireTimeRBV']    = get_pv(camera_prefix + 'AcquireTime_RBV')
+    epics_pvs['CamBinX']              = get_pv(camera_prefix + 'BinX')
+    epics_pvs['CamBinY']              = get_pv(camera_prefix + 'BinY')
+    epics_pvs['CamWaitForPlugins']    = get_pv(camera_prefix + 'WaitForPlugins')
+    epics_pvs['PortNameRBV']          = get_pv(camera_prefix + 'PortName_RBV')
+
+    epics_pvs['CamExposureMode']     = get_pv(camera_prefix + 'ExposureMode')
+    epics_pvs['CamTriggerOverlap']   = get_pv(camera_prefix + 'TriggerOverlap')
+    epics_pvs['CamPixelFormat']      = get_pv(camera_prefix + 'PixelFormat')
+    epics_pvs['CamArrayCallbacks']   = get_pv(camera_prefix + 'ArrayCallbacks')
+    epics_pvs['CamFrameRateEnable']  = get_pv(camera_prefix + 'FrameRateEnable')
+    epics_pvs['CamTriggerSource']    = get_pv(camera_prefix + 'TriggerSource')
 
     prefix = '2bma:PSOFly2:'
-    epics_pvs['PSOscanDelta']       = PV(prefix + 'scanDelta')
-    epics_pvs['PSOstartPos']        = PV(prefix + 'startPos')
-    epics_pvs['PSOendPos']          = PV(prefix + 'endPos')
-    epics_pvs['PSOslewSpeed']       = PV(prefix + 'slewSpeed')
-    epics_pvs['PSOtaxi']            = PV(prefix + 'taxi')
-    epics_pvs['PSOfly']             = PV(prefix + 'fly')
-    epics_pvs['PSOscanControl']     = PV(prefix + 'scanControl')
-    epics_pvs['PSOcalcProjections'] = PV(prefix + 'numTriggers')        
-    epics_pvs['ThetaArray']         = PV(prefix + 'motorPos.AVAL')
-
+    epics_pvs['PSOscanDelta']       = get_pv(prefix + 'scanDelta')
+    epics_pvs['PSOstartPos']        = get_pv(prefix + 'startPos')
+    epics_pvs['PSOendPos']          = get_pv(prefix + 'endPos')
+    epics_pvs['PSOslewSpeed']       = get_pv(prefix + 'slewSpeed')
+    epics_pvs['PSOtaxi']            = get_pv(prefix + 'taxi')
+    epics_pvs['PSOfly']             = get_pv(prefix + 'fly')
+    epics_pvs['PSOscanControl']     = get_pv(prefix + 'scanControl')
+    epics_pvs['PSOcalcProjections'] = get_pv(prefix + 'numTriggers')        
+    epics_pvs['ThetaArray']         = get_pv(prefix + 'motorPos.AVAL')
+
+    connect_pvs([epics_pv.pvname for epics_pv in epics_pvs.values()])
+
+    # only some models have a VideoMode PV, e.g. the Grasshopper3 but not the Oryx
+    if get_registry().has_video_modes(epics_pvs['CamModel'].get(as_string=True)):
+        epics_pvs['CamVideoMode'] = get_pv(camera_prefix + 'VideoMode')
+        connect_pvs([epics_pvs['CamVideoMode'].pvname])
     return epics_pvs
 
 def set_pso(epics_pvs, rotation_start, num_angles, rotation_step):
@@ -79,12 +71,15 @@ def set_pso(epics_pvs, rotation_start, num_angles, rotation_step):
 
     log.info('set_pso')
 
-    epics_pvs['PSOstartPos'].put(rotation_start, wait=True)
-    wait_pv(epics_pvs['PSOstartPos'], rotation_start)
-    epics_pvs['PSOendPos'].put(rotation_stop, wait=True)
-    wait_pv(epics_pvs['PSOendPos'], rotation_stop)
-    epics_pvs['PSOscanDelta'].put(rotation_step, wait=True)
-    wait_pv(epics_pvs['PSOscanDelta'], rotation_step)
+    # each pv is written once with put completion, endPos last, and the readbacks are
+    # checked once against the values the controller calculates after the encoder quantization
+    setup = pso_model.predict(rotation_start, rotation_stop, rotation_step)
+    done, status = pso_model.set_pso_pvs(epics_pvs, setup)
+    for pv_status in status:
+        log.info('%s predicted %s matches %s, put in %s s', pv_status.pvname, pv_status.wait_val,
+                 pv_status.satisfied, pv_status.elapsed)
+    if not done:
+        log.error('  *** PSOFly2 readbacks do not match the predicted set up %s', setup)
 
     calc_rotation_start = epics_pvs['PSOstartPos'].value
     calc_rotation_stop = epics_pvs['PSOendPos'].value
@@ -96,15 +91,17 @@ def set_pso(epics_pvs, rotation_start, num_angles, rotation_step):
     log.info('step entered/calculated %s, %s', rotation_step, calc_rotation_step)
     log.info('num_angles entered/calculated %s, %s', num_angles, calc_num_angles)
 
-    # theta = []
-    # theta = epics_pvs['ThetaArray'].get(count=int(num_angles))
-    # log.info('theta = ', theta)
+    # catch a short or stale theta array before the fly scan starts
+    theta = pso_model.read_theta(epics_pvs['ThetaArray'], num_angles)
+    check = pso_model.check_theta(theta, setup.rotation_start, setup.rotation_step)
+    if not check.valid:
+        log.error('  *** theta array does not match the set up: %s', check)
 
     return calc_num_angles, calc_rotation_step
 
 
-def set_trigger_mode(epics_pvs, trigger_mode, num_images):
-    """Sets the trigger mode SIS3820 and the camera.
+def trigger_mode_stages(trigger_mode, num_images):
+    """Camera settings for a trigger mode.
 
     Parameters
     ----------
@@ -113,36 +110,226 @@ def set_trigger_mode(epics_pvs, trigger_mode, num_images):
 
     num_images : int
         Number of images to collect.  Ignored if trigger_mode="FreeRun".
-        This is used to set the ``NumImages`` PV of the camera.
+
+    Returns
+    -------
+    list
+        Stages to apply in order. Each stage is a list of (epics_pvs key, value)
+        that do not depend on each other and can be written concurrently.
     """
 
-    epics_pvs['CamAcquire'].put('Done') ###
-    wait_pv(epics_pvs['CamAcquire'], 0) ###
-    log.info('set trigger mode: %s', trigger_mode)
     if trigger_mode == 'FreeRun':
-        epics_pvs['CamImageMode'].put('Continuous', wait=True)
-        epics_pvs['CamTriggerMode'].put('Off', wait=True)
-        wait_pv(epics_pvs['CamTriggerMode'], 0)
+        return [[('CamImageMode', 'Continuous'), ('CamTriggerMode', 'Off')]]
     elif trigger_mode == 'Internal':
-        epics_pvs['CamTriggerMode'].put('Off', wait=True)
-        wait_pv(epics_pvs['CamTriggerMode'], 0)
-        epics_pvs['CamImageMode'].put('Multiple')
-        epics_pvs['CamNumImages'].put(num_images, wait=True)
+        return [[('CamTriggerMode', 'Off'), ('CamImageMode', 'Multiple'), ('CamNumImages', num_images)]]
     else: # set camera to external triggering
+        # The camera only accepts trigger changes with TriggerMode Off, so it is turned Off first and On last.
         # These are just in case the scan aborted with the camera in another state
-        epics_pvs['CamTriggerMode'].put('Off', wait=True)
-        epics_pvs['CamTriggerSource'].put('Line2', wait=True)
-        epics_pvs['CamTriggerOverlap'].put('ReadOut', wait=True)
-        epics_pvs['CamExposureMode'].put('Timed', wait=True)
+        return [[('CamTriggerMode', 'Off')],
+                [('CamTriggerSource', 'Line2'),
+                 ('CamTriggerOverlap', 'ReadOut'),
+                 ('CamExposureMode', 'Timed'),
+                 ('CamImageMode', 'Multiple'),
+                 ('CamArrayCallbacks', 'Enable'),
+                 ('CamFrameRateEnable', 0),
+                 ('CamNumImages', num_images)],
+                [('CamTriggerMode', 'On')]]
+
+
+class CameraState():
+    """Monitor backed mirror of the camera settings written by set_trigger_mode().
+
+    Parameters
+    ----------
+    epics_pvs : dict
+        The dictionary returned by set_pvs()
+    """
+
+    keys = ['CamAcquire', 'CamTriggerMode', 'CamTriggerSource', 'CamTriggerOverlap', 'CamExposureMode',
+            'CamImageMode', 'CamArrayCallbacks', 'CamFrameRateEnable', 'CamNumImages']
+
+    def __init__(self, epics_pvs):
+        self.lock = threading.Lock()
+        # (value, char_value) of each setting
+        self.settings = {}
+        for key in self.keys:
+            epics_pvs[key].add_callback(self._make_callback(key))
+            with self.lock:
+                self.settings[key] = (epics_pvs[key].get(), epics_pvs[key].get(as_string=True))
+
+    def _make_callback(self, key):
+        def on_change(value=None, char_value=None, **kwargs):
+            with self.lock:
+                self.settings[key] = (value, char_value)
+        return on_change
+
+    @staticmethod
+    def _has_value(setting, value):
+        # strings are enum choices, compare them to the enum string
+        if isinstance(value, str):
+            return setting[1] == value
+        return matches(setting[0], value)
+
+    @staticmethod
+    def _setting(value):
+        if isinstance(value, str):
+            return (None, value)
+        return (value, str(value))
+
+    def is_set(self, key, value):
+        """True if the camera setting already has value"""
+
+        with self.lock:
+            return self._has_value(self.settings[key], value)
+
+    def is_acquiring(self):
+        return not self.is_set('CamAcquire', 0)
+
+    def written(self, stage):
+        """Records a stage of puts that completed, ahead of their monitor updates"""
+
+        with self.lock:
+            for key, value in stage:
+                self.settings[key] = self._setting(value)
+
+    def diff(self, trigger_mode, num_images):
+        """Minimal set of writes to reach a trigger mode.
+
+        Returns
+        -------
+        list
+            The stages of trigger_mode_stages() keeping only the writes that change a setting.
+            Empty if the camera is already in the requested mode.
+        """
+
+        stages = trigger_mode_stages(trigger_mode, num_images)
+        with self.lock:
+            settings = dict(self.settings)
+        # final value of each setting, TriggerMode is written twice for PSOExternal
+        target = dict(pair for stage in stages for pair in stage)
+        if all(self._has_value(settings[key], value) for key, value in target.items()):
+            return []
+
+        # follow the stages on a copy of the settings, so TriggerMode is still turned
+        # Off before the other settings and On after them when it is currently On
+        writes = []
+        for stage in stages:
+            stage = [(key, value) for key, value in stage if not self._has_value(settings[key], value)]
+            for key, value in stage:
+                settings[key] = self._setting(value)
+            if stage:
+                writes.append(stage)
+        return writes
+
+
+def set_trigger_mode(epics_pvs, trigger_mode, num_images, camera_state=None):
+    """Sets the trigger mode SIS3820 and the camera.
+
+    The puts of each stage of trigger_mode_stages() are issued concurrently.
+
+    Parameters
+    ----------
+    trigger_mode : str
+        Choices are: "FreeRun", "Internal", or "PSOExternal"
+
+    num_images : int
+        Number of images to collect.  Ignored if trigger_mode="FreeRun".
+        This is used to set the ``NumImages`` PV of the camera.
+
+    camera_state : CameraState
+        If given, acquisition is only stopped if running and only the settings
+        that differ from the requested mode are written
+
+    Returns
+    -------
+    float
+        The time in seconds it took to configure the camera
+    """
+
+    start_time = time.time()
+    if camera_state is None or camera_state.is_acquiring():
+        epics_pvs['CamAcquire'].put('Done') ###
+        wait_pv(epics_pvs['CamAcquire'], 0, tolerance=EPSILON) ###
+    log.info('set trigger mode: %s', trigger_mode)
+    if camera_state is None:
+        stages = trigger_mode_stages(trigger_mode, num_images)
+    else:
+        stages = camera_state.diff(trigger_mode, num_images)
+        log.info('camera settings to write: %s', [key for stage in stages for key, _ in stage])
+    for stage in stages:
+        put_all([(epics_pvs[key], value) for key, value in stage])
+        if camera_state is not None:
+            camera_state.written(stage)
+    wait_pv(epics_pvs['CamTriggerMode'], 0 if trigger_mode in ('FreeRun', 'Internal') else 1, tolerance=EPSILON)
+
+    config_time = time.time() - start_time
+    log.info('trigger mode %s set in %.3f s', trigger_mode, config_time)
+    return config_time
+
+
+async def set_pso_async(epics_pvs, rotation_start, num_angles, rotation_step):
+    """asyncio version of set_pso()"""
+
+    rotation_stop = rotation_start + (rotation_step * num_angles)
+    pvs = async_pvs(epics_pvs)
+
+    log.info('set_pso_async')
+
+    # gather starts the puts in order and waits for their completions together,
+    # endPos goes last so the trigger calculation uses the final step
+    setup = pso_model.predict(rotation_start, rotation_stop, rotation_step)
+    await asyncio.gather(pvs['PSOstartPos'].put(rotation_start),
+                         pvs['PSOscanDelta'].put(rotation_step),
+                         pvs['PSOendPos'].put(rotation_stop))
+    try:
+        await pvs['PSOcalcProjections'].wait_for(setup.num_angles, timeout=10, tolerance=0.5)
+    except asyncio.TimeoutError:
+        log.error('  *** PSOFly2 readbacks do not match the predicted set up %s', setup)
+    calc_rotation_start, calc_rotation_stop, calc_rotation_step, calc_num_angles = await asyncio.gather(
+        pvs['PSOstartPos'].get(), pvs['PSOendPos'].get(), pvs['PSOscanDelta'].get(), pvs['PSOcalcProjections'].get())
+
+    log.info('start entered/calculated %s, %s', rotation_start, calc_rotation_start)
+    log.info('stop entered/calculated %s, %s', rotation_stop, calc_rotation_stop)
+    log.info('step entered/calculated %s, %s', rotation_step, calc_rotation_step)
+    log.info('num_angles entered/calculated %s, %s', num_angles, calc_num_angles)
+
+    return calc_num_angles, calc_rotation_step
+
+
+async def set_trigger_mode_async(epics_pvs, trigger_mode, num_images):
+    """asyncio version of set_trigger_mode()"""
+
+    pvs = async_pvs(epics_pvs)
+
+    await pvs['CamAcquire'].put('Done')
+    await pvs['CamAcquire'].wait_for(0)
+    log.info('set trigger mode: %s', trigger_mode)
+    for stage in trigger_mode_stages(trigger_mode, num_images):
+        await asyncio.gather(*[pvs[key].put(value) for key, value in stage])
+    await pvs['CamTriggerMode'].wait_for(0 if trigger_mode in ('FreeRun', 'Internal') else 1)
+
+
+async def setup_scan_async(epics_pvs, rotation_start, num_angles, rotation_step):
+    """Configures PSOFly2 and arms the camera for external triggering concurrently
+
+    Returns
+    -------
+    tuple
+        calc_num_angles and calc_rotation_step as returned by set_pso()
+    """
 
-        epics_pvs['CamImageMode'].put('Multiple')
-        epics_pvs['CamArrayCallbacks'].put('Enable')
-        epics_pvs['CamFrameRateEnable'].put(0)
+    pso_result, _ = await asyncio.gather(set_pso_async(epics_pvs, rotation_start, num_angles, rotation_step),
+                                         set_trigger_mode_async(epics_pvs, 'PSOExternal', num_angles))
+    return pso_result
 
-        num_angles = num_images
-        epics_pvs['CamNumImages'].put(num_angles, wait=True)
-        epics_pvs['CamTriggerMode'].put('On', wait=True)
-        wait_pv(epics_pvs['CamTriggerMode'], 1)
+
+def camera_identity(epics_pvs):
+    """CameraIdentity of the camera of epics_pvs, created with its monitors on first use"""
+
+    key = epics_pvs['CamModel']
+    if key not in _camera_identities:
+        _camera_identities[key] = CameraIdentity(epics_pvs)
+    return _camera_identities[key]
 
 
 def compute_frame_time(epics_pvs):
@@ -156,11 +343,9 @@ def compute_frame_time(epics_pvs):
     of the camera, and on a variety of camera configuration settings (pixel binning,
     pixel bit depth, video mode, etc.)
 
-    The current version only supports the Point Grey Grasshopper3 GS3-U3-23S6M.
-    The logic for additional cameras should be added to this function in the future
-    if the camera is expected to be used at more than one beamline.
-    If the camera is only to be used at a single beamline then the code should be added
-    to this method in the derived class
+    The readout times are in camera_readout.json, additional cameras are added there
+    or in ~/.config/camera_readout.json without changing this function. When the
+    configuration was calibrated by calibrate.py the measured frame time is used.
 
     Returns
     -------
@@ -169,71 +354,312 @@ def compute_frame_time(epics_pvs):
         ``ExposureTime`` PV.
     """
     # The readout time of the camera depends on the model, and things like the
-    # PixelFormat, VideoMode, etc.
-    # The measured times in ms with 100 microsecond exposure time and 1000 frames
-    # without dropping
-    camera_model = epics_pvs['CamModel'].get(as_string=True)
-    pixel_format = epics_pvs['CamPixelFormat'].get(as_string=True)
-    readout = None
-    if camera_model == 'Grasshopper3 GS3-U3-23S6M':
-        video_mode   = epics_pvs['CamVideoMode'].get(as_string=True)
-        readout_times = {
-            'Mono8':        {'Mode0': 6.2,  'Mode1': 6.2, 'Mode5': 6.2, 'Mode7': 7.9},
-            'Mono12Packed': {'Mode0': 9.2,  'Mode1': 6.2, 'Mode5': 6.2, 'Mode7': 11.5},
-            'Mono16':       {'Mode0': 12.2, 'Mode1': 6.2, 'Mode5': 6.2, 'Mode7': 12.2}
-        }
-        readout = readout_times[pixel_format][video_mode]/1000.
-    if camera_model == 'Oryx ORX-10G-51S5M':
-        # video_mode   = epics_pvs['CamVideoMode'].get(as_string=True)
-        readout_times = {
-            'Mono8': 6.18,
-            'Mono12Packed': 8.20,
-            'Mono16': 12.34
-        }
-        readout = readout_times[pixel_format]/1000.
+    # PixelFormat, VideoMode, etc. It comes from the camera_readout registry, the
+    # camera identity and exposure are kept up to date by monitors
+    camera = camera_identity(epics_pvs)
+    readout = camera.readout()
     if readout is None:
-        log.error('Unsupported combination of camera model, pixel format and video mode: %s %s %s',
-                      camera_model, pixel_format, video_mode)
-        return 0
-
-    # We need to use the actual exposure time that the camera is using, not the requested time
-    exposure = epics_pvs['CamAcquireTimeRBV'].value
-    # Add 1 or 5 ms to exposure time for margin
-    if exposure > 2.3:
-        frame_time = exposure + .005
-    elif exposure > 1.0:
-        frame_time = exposure + .002
-    else:
-        frame_time = exposure + .001
+        # unknown camera, only the exposure time and margin are used
+        readout = 0
+
+    # a frame time measured by calibrate.py for this configuration and exposure is
+    # the hardware limit, the margins below are only for uncalibrated exposures
+    frame_time = camera.calibrated_frame_time()
+    if frame_time is None:
+        # We need to use the actual exposure time that the camera is using, not the requested time
+        exposure = camera.exposure
+        # Add 1 or 5 ms to exposure time for margin
+        if exposure > 2.3:
+            frame_time = exposure + .005
+        elif exposure > 1.0:
+            frame_time = exposure + .002
+        else:
+            frame_time = exposure + .001
 
     # If the time is less than the readout time then use the readout time
     if frame_time < readout:
         frame_time = readout
     return frame_time
 
-def wait_camera_done(epics_pvs, timeout):
-    """Waits for the camera acquisition to complete, or for ``abort_scan()`` to be called.
+CameraDone = collections.namedtuple('CameraDone', ['done', 'frames', 'elapsed', 'rate', 'longest_gap'])
 
-    While waiting this method periodically updates the status PVs ``ImagesCollected``,
-    ``ImagesSaved``, ``ElapsedTime``, and ``RemainingTime``.
+
+def wait_camera_done(epics_pvs, timeout, num_images=None, progress_interval=5.0):
+    """Waits for the camera acquisition to complete.
+
+    CamAcquireBusy and CamNumImagesCounter are monitored, so the wait sleeps
+    until the acquisition ends instead of polling. Every progress_interval
+    seconds the frames collected, the frame rate and the ETA are logged.
 
     Parameters
     ----------
     timeout : float
-        The maximum number of seconds to wait before raising a CameraTimeoutError exception.
-
-    Raises
-    ------
-    ScanAbortError
-        If ``abort_scan()`` is called
-    CameraTimeoutError
-        If acquisition has not completed within timeout value.
+        The maximum number of seconds to wait, -1 to wait forever.
+    num_images : int
+        Number of images expected, used for the ETA. Read from CamNumImages if None.
+    progress_interval : float
+        Seconds between progress messages.
+
+    Returns
+    -------
+    CameraDone
+        done: False if the timeout was reached; frames: images collected;
+        elapsed: seconds waited; rate: average frames/s; longest_gap: longest
+        time in s without a new frame, counted from the start of the wait
     """
 
+    if num_images is None:
+        num_images = epics_pvs['CamNumImages'].get()
+    lock = threading.Lock()
+    finished = threading.Event()
     start_time = time.time()
-    while True:
-        if epics_pvs['CamAcquireBusy'].value == 0:
-            return
+    frames = [epics_pvs['CamNumImagesCounter'].get()]
+    last_frame = [start_time]
+    longest_gap = [0.0]
+
+    def on_busy(value=None, **kwargs):
+        if value == 0:
+            finished.set()
+
+    def on_counter(value=None, **kwargs):
+        now = time.time()
+        with lock:
+            if value != frames[0]:
+                longest_gap[0] = max(longest_gap[0], now - last_frame[0])
+                last_frame[0] = now
+                frames[0] = value
+
+    busy_index = epics_pvs['CamAcquireBusy'].add_callback(on_busy)
+    counter_index = epics_pvs['CamNumImagesCounter'].add_callback(on_counter)
+    try:
+        if epics_pvs['CamAcquireBusy'].get() == 0:
+            finished.set()
+        while True:
+            elapsed = time.time() - start_time
+            wait_time = progress_interval if timeout < 0 else min(progress_interval, timeout - elapsed)
+            if finished.wait(max(wait_time, 0)):
+                break
+            elapsed = time.time() - start_time
+            with lock:
+                collected = frames[0]
+            rate = collected / elapsed if elapsed > 0 else 0.0
+            if timeout >= 0 and elapsed >= timeout:
+                log.error('  *** ERROR: DROPPED IMAGES ***')
+                log.error('  *** wait_camera_done reached max timeout %5.2f s with %d/%d frames',
+                          timeout, collected, num_images)
+                break
+            eta = (num_images - collected) / rate if rate > 0 else float('inf')
+            log.info('  frames %d/%d, %.1f frames/s, ETA %.1f s', collected, num_images, rate, eta)
+    finally:
+        epics_pvs['CamAcquireBusy'].remove_callback(busy_index)
+        epics_pvs['CamNumImagesCounter'].remove_callback(counter_index)
+
+    end_time = time.time()
+    with lock:
+        collected = frames[0]
+        gap = longest_gap[0]
+        active = last_frame[0] - start_time
+    if not finished.is_set():
+        # a stalled camera shows up as a gap lasting until the timeout
+        gap = max(gap, end_time - last_frame[0])
+    summary = CameraDone(finished.is_set(), collected, end_time - start_time,
+                         collected / active if active > 0 else 0.0, gap)
+    log.info('camera done: %d frames in %.3f s, %.1f frames/s, longest gap %.3f s',
+             summary.frames, summary.elapsed, summary.rate, summary.longest_gap)
+    return summary
+
+def fly_scan(epics_pvs, num_angles):
+    """Starts the PSO fly and waits for the camera, following the frames against the triggers
+
+    Returns
+    -------
+    camera_done : CameraDone
+        Returned by wait_camera_done()
+    drops : DropReport
+        Timeline of the windows where the camera fell behind the PSO triggers
+    """
+
+    time_per_angle = compute_frame_time(epics_pvs)
+    log.info('Time per angle: %s', time_per_angle)
+    trigger_period = epics_pvs['PSOscanDelta'].get() / epics_pvs['PSOslewSpeed'].get()
+    detector = DropDetector(epics_pvs, epics_pvs['PSOcalcProjections'].get(), trigger_period, time_per_angle)
+    detector.start()
+    # Start fly scan
+    epics_pvs['PSOfly'].put(1) #, wait=True)
+    # wait for acquire to finish
+    # wait_camera_done instead of the wait_pv enabled the counter update
+    # self.wait_pv(epics_pvs['PSOfly'], 0)
+    collection_time = num_angles * time_per_angle
+    camera_done = wait_camera_done(epics_pvs, collection_time + 60., num_angles)
+    drops = detector.stop()
+    return camera_done, drops
+
+def scan_cycle(epics_pvs, rotation_start, num_angles, rotation_step, camera_state=None):
+    """Runs one PSO fly scan and puts the camera back in FreeRun.
+
+    Parameters
+    ----------
+    rotation_start, num_angles, rotation_step
+        Scan parameters passed to set_pso()
+
+    camera_state : CameraState
+        Passed to set_trigger_mode()
+    """
+
+    set_pso(epics_pvs, rotation_start, num_angles, rotation_step)
+    log.info('taxi before starting capture')
+    # Taxi before starting capture
+    epics_pvs['PSOtaxi'].put(1, wait=True)
+    wait_pv(epics_pvs['PSOtaxi'], 0, tolerance=EPSILON)
+    set_trigger_mode(epics_pvs, 'PSOExternal', num_angles, camera_state)
+    # Start the camera
+    epics_pvs['CamAcquire'].put('Acquire')
+    wait_pv(epics_pvs['CamAcquire'], 1, tolerance=EPSILON)
+    log.info('start fly scan')
+    fly_scan(epics_pvs, num_angles)
+
+    set_trigger_mode(epics_pvs, 'FreeRun', 1, camera_state)
+    epics_pvs['CamAcquire'].put('Acquire')
+    wait_pv(epics_pvs['CamAcquire'], 1, tolerance=EPSILON)
+
+ScanStage = collections.namedtuple('ScanStage', ['name', 'function', 'depends'])
+StageTiming = collections.namedtuple('StageTiming', ['name', 'start', 'end', 'blocked'])
+
+
+def run_stages(stages, executor):
+    """Runs scan stages concurrently, each one as soon as the stages it depends on are done
+
+    Parameters
+    ----------
+    stages : list of ScanStage
+        name, function called without arguments and names of the stages it depends on,
+        a stage can only depend on stages listed before it
+    executor : concurrent.futures.ThreadPoolExecutor
+        Needs at least len(stages) workers, a stage blocks a worker while it waits
+
+    Returns
+    -------
+    list of StageTiming
+        For each stage its start and end in s from the start of the first stage
+        and the time it waited for its dependencies
+    """
+
+    futures = {}
+    start_time = time.time()
+
+    def run(stage):
+        wait_time = time.time()
+        for name in stage.depends:
+            futures[name].result()
+        stage_start = time.time()
+        stage.function()
+        return StageTiming(stage.name, stage_start - start_time, time.time() - start_time,
+                           stage_start - wait_time)
+
+    for stage in stages:
+        futures[stage.name] = executor.submit(run, stage)
+    return [futures[stage.name].result() for stage in stages]
+
+
+def scan_stages(epics_pvs, scan, next_scan=None, camera_state=None, setup_pso=True, timeout=10):
+    """Stages of one fly scan for run_stages()
+
+    The PSO taxi and the camera arming use independent hardware and run at the
+    same time, the acquisition starts when both are done. The PSO set up of
+    next_scan runs during the FreeRun teardown of this scan, once the fly is done.
+
+    Parameters
+    ----------
+    scan, next_scan : tuple
+        (rotation_start, num_angles, rotation_step), next_scan None for the last scan
+    setup_pso : bool
+        False if the PSO was already set up for scan, i.e. by the previous cycle
+    timeout : float
+        Seconds the next_pso stage waits for the controller to end the fly
+        before it fails with TimeoutError
+    """
+
+    rotation_start, num_angles, rotation_step = scan
+
+    def taxi():
+        epics_pvs['PSOtaxi'].put(1, wait=True)
+        wait_pv(epics_pvs['PSOtaxi'], 0, tolerance=EPSILON)
+
+    def acquire():
+        epics_pvs['CamAcquire'].put('Acquire')
+        wait_pv(epics_pvs['CamAcquire'], 1, tolerance=EPSILON)
+
+    def fly():
+        fly_scan(epics_pvs, num_angles)
+
+    def teardown():
+        set_trigger_mode(epics_pvs, 'FreeRun', 1, camera_state)
+        acquire()
+
+    def next_pso():
+        # the controller must have finished the fly before it is reconfigured
+        if not wait_pv(epics_pvs['PSOfly'], 0, timeout, tolerance=EPSILON):
+            raise TimeoutError('PSOFly2 still flying %.1f s after the camera was done' % timeout)
+        set_pso(epics_pvs, *next_scan)
+
+    stages = []
+    if setup_pso:
+        stages.append(ScanStage('pso', lambda: set_pso(epics_pvs, *scan), ()))
+    stages.append(ScanStage('taxi', taxi, ('pso',) if setup_pso else ()))
+    stages.append(ScanStage('arm_camera', lambda: set_trigger_mode(epics_pvs, 'PSOExternal', num_angles,
+                                                                   camera_state), ()))
+    stages.append(ScanStage('acquire', acquire, ('taxi', 'arm_camera')))
+    stages.append(ScanStage('fly', fly, ('acquire',)))
+    stages.append(ScanStage('teardown', teardown, ('fly',)))
+    if next_scan is not None:
+        stages.append(ScanStage('next_pso', next_pso, ('fly',)))
+    return stages
+
+
+def run_pipelined_scans(epics_pvs, scans, camera_state=None, history=100):
+    """Runs fly scans with the stages of scan_cycle() overlapped where the hardware allows
+
+    Logs for every cycle the duration of each stage, how long it waited on the
+    stages it depends on, the cycle time against the sum of the stage times,
+    i.e. what the same stages take one after the other, and the dead time
+    spent outside the fly.
+
+    Parameters
+    ----------
+    scans : iterable of tuple
+        (rotation_start, num_angles, rotation_step) of each scan, can be endless
+    history : int
+        Number of cycles whose timings are kept, None keeps all of them
+
+    Returns
+    -------
+    list of list of StageTiming
+        Timings of the last history cycles
+    """
+
+    scans = iter(scans)
+    scan = next(scans, None)
+    setup_pso = True
+    cycles = collections.deque(maxlen=history)
+    num_cycles = 0
+    with concurrent.futures.ThreadPoolExecutor(max_workers=8, thread_name_prefix='scan_stage') as executor:
+        while scan is not None:
+            next_scan = next(scans, None)
+            timings = run_stages(scan_stages(epics_pvs, scan, next_scan, camera_state, setup_pso), executor)
+            cycle_time = max(timing.end for timing in timings)
+            serial_time = sum(timing.end - timing.start for timing in timings)
+            for timing in timings:
+                log.info('  stage %-10s %7.3f s, started at %7.3f s after waiting %7.3f s on its dependencies',
+                         timing.name, timing.end - timing.start, timing.start, timing.blocked)
+            fly_time = sum(timing.end - timing.start for timing in timings if timing.name == 'fly')
+            log.info('cycle %d: %.3f s, %.3f s in sequence, %.3f s saved, %.3f s dead time outside the fly',
+                     num_cycles, cycle_time, serial_time, serial_time - cycle_time, cycle_time - fly_time)
+            cycles.append(timings)
+            num_cycles += 1
+            scan = next_scan
+            setup_pso = False
+    return list(cycles)
+
 
 def main():
 
@@ -248,35 +674,14 @@ def main():
     log.setup_custom_logger(lfname)
 
     epics_pvs = set_pvs()
+    camera_state = CameraState(epics_pvs)
 
     rotation_start = 0 
     num_angles = 100
     rotation_step = 0.1
 
-    while (True):
-        set_pso(epics_pvs, rotation_start, num_angles, rotation_step)
-        log.info('taxi before starting capture')
-        # Taxi before starting capture
-        epics_pvs['PSOtaxi'].put(1, wait=True)
-        wait_pv(epics_pvs['PSOtaxi'], 0)
-        set_trigger_mode(epics_pvs, 'PSOExternal', num_angles)
-        # Start the camera
-        epics_pvs['CamAcquire'].put('Acquire')
-        wait_pv(epics_pvs['CamAcquire'], 1)
-        log.info('start fly scan')
-        # Start fly scan
-        epics_pvs['PSOfly'].put(1) #, wait=True)
-        # wait for acquire to finish
-        # wait_camera_done instead of the wait_pv enabled the counter update
-        # self.wait_pv(epics_pvs['PSOfly'], 0)
-        time_per_angle = compute_frame_time(epics_pvs)
-        log.info('Time per angle: %s', time_per_angle)
-        collection_time = num_angles * time_per_angle
-        wait_camera_done(epics_pvs, collection_time + 60.)
-
-        set_trigger_mode(epics_pvs, 'FreeRun', 1)
-        epics_pvs['CamAcquire'].put('Acquire')
-        wait_pv(epics_pvs['CamAcquire'], 1)
+    run_pipelined_scans(epics_pvs, itertools.repeat((rotation_start, num_angles, rotation_step)), camera_state,
+                        history=0)
 
 if __name__ == "__main__":
     main()
@@ -1,45 +1,26 @@
 import time
-from epics import PV
+
+from pv_util import wait_pv, put_all, get_pv, connect_pvs
+from trigger_mode import trigger_mode_stages
 
 def set_pvs():
     epics_pvs = {}
 
     camera_prefix = '2bmbSP1:cam1:'
-    epics_pvs['CamAcquire']           = PV(camera_prefix + 'Acquire')
-    epics_pvs['CamTriggerMode']       = PV(camera_prefix + 'TriggerMode')
-    epics_pvs['CamNumImages']         = PV(camera_prefix + 'NumImages')
-    epics_pvs['CamImageMode']         = PV(camera_prefix + 'ImageMode')
+    epics_pvs['CamAcquire']           = get_pv(camera_prefix + 'Acquire')
+    epics_pvs['CamTriggerMode']       = get_pv(camera_prefix + 'TriggerMode')
+    epics_pvs['CamNumImages']         = get_pv(camera_prefix + 'NumImages')
+    epics_pvs['CamImageMode']         = get_pv(camera_prefix + 'ImageMode')
 
-    epics_pvs['CamExposureMode']     = PV(camera_prefix + 'ExposureMode')
-    epics_pvs['CamTriggerOverlap']   = PV(camera_prefix + 'TriggerOverlap')
-    epics_pvs['CamArrayCallbacks']   = PV(camera_prefix + 'ArrayCallbacks')
-    epics_pvs['CamFrameRateEnable']  = PV(camera_prefix + 'FrameRateEnable')
-    epics_pvs['CamTriggerSource']    = PV(camera_prefix + 'TriggerSource')
+    epics_pvs['CamExposureMode']     = get_pv(camera_prefix + 'ExposureMode')
+    epics_pvs['CamTriggerOverlap']   = get_pv(camera_prefix + 'TriggerOverlap')
+    epics_pvs['CamArrayCallbacks']   = get_pv(camera_prefix + 'ArrayCallbacks')
+    epics_pvs['CamFrameRateEnable']  = get_pv(camera_prefix + 'FrameRateEnable')
+    epics_pvs['CamTriggerSource']    = get_pv(camera_prefix + 'TriggerSource')
 
+    connect_pvs([epics_pv.pvname for epics_pv in epics_pvs.values()])
     return epics_pvs
 
-def wait_pv(epics_pv, wait_val, timeout=-1):
-    """Wait on a pv to be a value until max_timeout (default forever)
-       delay for pv to change
-    """
-
-    time.sleep(.01)
-    start_time = time.time()
-    while True:
-        pv_val = epics_pv.get()
-        if isinstance(pv_val, float):
-            if abs(pv_val - wait_val) < EPSILON:
-                return True
-        if pv_val != wait_val:
-            if timeout > -1:
-                current_time = time.time()
-                diff_time = current_time - start_time
-                if diff_time >= timeout:
-                    print('  *** ERROR: DROPPED IMAGES ***')                  
-                    return False
-            time.sleep(.01)
-        else:
-            return True
 
 def set_trigger_mode(epics_pvs, trigger_mode):
     """Sets the trigger mode SIS3820 and the camera.
@@ -49,32 +30,23 @@ def set_trigger_mode(epics_pvs, trigger_mode):
     trigger_mode : str
         Choices are: "FreeRun" or "PSOExternal"
 
-    num_images : int
-        Number of images to collect.  Ignored if trigger_mode="FreeRun".
-        This is used to set the ``NumImages`` PV of the camera.
+    Returns
+    -------
+    float
+        The time in seconds it took to configure the camera
     """
 
+    start_time = time.time()
     epics_pvs['CamAcquire'].put('Done') ###
     wait_pv(epics_pvs['CamAcquire'], 0) ###
     print('set trigger mode: ', trigger_mode)
-    if trigger_mode == 'FreeRun':
-        epics_pvs['CamImageMode'].put('Continuous', wait=True)
-        epics_pvs['CamTriggerMode'].put('Off', wait=True)
-        wait_pv(epics_pvs['CamTriggerMode'], 0)
-    else: # set camera to external triggering
-        # These are just in case the scan aborted with the camera in another state
-        epics_pvs['CamTriggerMode'].put('Off', wait=True)
-        epics_pvs['CamTriggerSource'].put('Line2', wait=True)
-        epics_pvs['CamTriggerOverlap'].put('ReadOut', wait=True)
-        epics_pvs['CamExposureMode'].put('Timed', wait=True)
-
-        epics_pvs['CamImageMode'].put('Multiple')
-        epics_pvs['CamArrayCallbacks'].put('Enable')
-        epics_pvs['CamFrameRateEnable'].put(0)
+    for stage in trigger_mode_stages(trigger_mode, 100):
+        put_all([(epics_pvs[key], value) for key, value in stage])
+    wait_pv(epics_pvs['CamTriggerMode'], 0 if trigger_mode == 'FreeRun' else 1)
 
-        epics_pvs['CamNumImages'].put(100, wait=True)
-        epics_pvs['CamTriggerMode'].put('On', wait=True)
-        wait_pv(epics_pvs['CamTriggerMode'], 1)
+    config_time = time.time() - start_time
+    print('set in %.3f s' % config_time)
+    return config_time
 
 def main():
     epics_pvs = set_pvs()